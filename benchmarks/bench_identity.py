@@ -0,0 +1,59 @@
+"""Compare speed and deduplication of the identity strategies of sygma.Tree on a set of drugs"""
+import argparse
+import os
+import time
+import sygma
+from rdkit import Chem, RDLogger
+from sygma.treenode import identity_keys, mol_to_ikey
+RDLogger.DisableLog('rdApp.*')
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def read_smiles(filename):
+    """Return a list of (name, RDKit molecule) tuples read from a file with lines 'smiles name'"""
+    mols = []
+    for line in open(filename):
+        if line.strip() and line[0] != "#":
+            smiles, name = (line.split() + [""])[:2]
+            mols.append((name or smiles, Chem.MolFromSmiles(smiles)))
+    return mols
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--smiles', help="File with 'smiles name' lines (default: %(default)s)",
+                    default=os.path.join(here, 'drugs.smi'))
+    ap.add_argument('--rules1', help="Phase 1 rules file (default: the phase1 ruleset)", default=None)
+    ap.add_argument('--rules2', help="Phase 2 rules file (default: the phase2 ruleset)", default=None)
+    ap.add_argument('-1', '--phase1', help="Number of phase 1 cycles (default: %(default)s)", default=2, type=int)
+    ap.add_argument('-2', '--phase2', help="Number of phase 2 cycles (default: %(default)s)", default=1, type=int)
+    args = ap.parse_args()
+
+    parents = read_smiles(args.smiles)
+    results = {}
+    for identity in identity_keys:
+        scenario = sygma.Scenario([
+            [args.rules1 or sygma.ruleset['phase1'], args.phase1],
+            [args.rules2 or sygma.ruleset['phase2'], args.phase2]], identity=identity)
+        start = time.time()
+        trees = [scenario.run(Chem.Mol(mol)) for name, mol in parents]
+        elapsed = time.time() - start
+        n_nodes = sum(len(tree.nodes) for tree in trees)
+        # number of distinct metabolites per parent according to the (truncated) InChIKey
+        n_inchikeys = sum(len(set(mol_to_ikey(node.mol) for node in tree.nodes.values())) for tree in trees)
+        results[identity] = [tree.nodes for tree in trees]
+        print("{:10s} {:8.2f} s  {:7d} nodes  {:7d} distinct InChIKeys".format(
+            identity, elapsed, n_nodes, n_inchikeys))
+
+    # list the parents for which a strategy deduplicates differently from the InChIKey strategy
+    for identity in identity_keys:
+        if identity == "inchikey":
+            continue
+        for (name, mol), nodes, reference in zip(parents, results[identity], results["inchikey"]):
+            if len(nodes) != len(reference):
+                print("{:10s} {}: {} nodes, inchikey: {} nodes".format(identity, name, len(nodes), len(reference)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Measure the time to import sygma, to keep the start up time of the sygma command and workers low"""
+import argparse
+import subprocess
+import sys
+import time
+
+statements = [
+    "import sygma",
+    "import sygma.script",
+    "import sygma; sygma.Scenario",
+]
+
+
+def time_statement(statement, repeat):
+    """Return the minimum wall time in seconds of running statement in a new python process"""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', statement])
+        times.append(time.time() - start)
+    return min(times)
+
+
+def slowest_imports(statement, n):
+    """Return the n modules with the highest cumulative import time (microseconds) reported by -X importtime"""
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            stderr=subprocess.PIPE, universal_newlines=True).stderr
+    imports = []
+    for line in output.splitlines()[1:]:
+        self_time, cumulative, module = line.split('|')
+        imports.append((int(cumulative.split(':')[-1]), module.rstrip()))
+    return sorted(imports, reverse=True)[:n]
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('-r', '--repeat', help="Number of repeats (default: %(default)s)", default=5, type=int)
+    ap.add_argument('-n', '--slowest', help="Number of slowest imports to list (default: %(default)s)",
+                    default=5, type=int)
+    args = ap.parse_args()
+
+    baseline = time_statement("pass", args.repeat)
+    print("{:35s} {:8.3f} s".format("python start up", baseline))
+    for statement in statements:
+        print("{:35s} {:8.3f} s".format(statement, time_statement(statement, args.repeat) - baseline))
+        for cumulative, module in slowest_imports(statement, args.slowest):
+            print("    {:10.3f} s {}".format(cumulative / 1e6, module))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Compare the memory used by the trees of a set of drugs with the compact TreeNode layout and the previous layout"""
+import argparse
+import gc
+import os
+import resource
+import subprocess
+import sys
+import sygma
+from rdkit import Chem, RDLogger
+RDLogger.DisableLog('rdApp.*')
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+class LegacyTreeNode(object):
+    """The previous layout of TreeNode: a full molecule with its reactants, parents with rules and child keys"""
+
+    def __init__(self, tree, node):
+        self.mol = node.mol
+        self.reactants = [Chem.MolFromSmiles(part) for part in Chem.MolToSmiles(self.mol).split('.')]
+        self.parents = tree.node_parents(node)
+        self.children = [tree.keys[idx] for idx in node.children]
+        self.ikey = node.ikey
+        self.score = node.score
+        self.pathway = node.pathway
+        self.uniqueIdent = node.uniqueIdent
+        self.n_original_atoms = node.n_original_atoms
+
+
+def rss():
+    """Return the current resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(args):
+    """Build the trees of all parents, keeping the nodes in args.layout, and print the number of nodes and bytes"""
+    scenario = sygma.Scenario([
+        [args.rules1 or sygma.ruleset['phase1'], args.phase1],
+        [args.rules2 or sygma.ruleset['phase2'], args.phase2]])
+    parents = [Chem.MolFromSmiles(line.split()[0]) for line in open(args.smiles) if line.strip()]
+    gc.collect()
+    start = rss()
+    kept = []
+    for parent in parents:
+        tree = scenario.run(parent)
+        tree.calc_scores()
+        if args.layout == 'legacy':
+            kept.append([LegacyTreeNode(tree, node) for node in tree.nodes.values()])
+        else:
+            kept.append(tree)
+        del tree
+    gc.collect()
+    print(sum(len(nodes) if args.layout == 'legacy' else len(nodes.nodes) for nodes in kept), rss() - start)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--smiles', help="File with 'smiles name' lines (default: %(default)s)",
+                    default=os.path.join(here, 'drugs.smi'))
+    ap.add_argument('--rules1', help="Phase 1 rules file (default: the phase1 ruleset)", default=None)
+    ap.add_argument('--rules2', help="Phase 2 rules file (default: the phase2 ruleset)", default=None)
+    ap.add_argument('-1', '--phase1', help="Number of phase 1 cycles (default: %(default)s)", default=2, type=int)
+    ap.add_argument('-2', '--phase2', help="Number of phase 2 cycles (default: %(default)s)", default=1, type=int)
+    ap.add_argument('--layout', help=argparse.SUPPRESS, choices=['compact', 'legacy'])
+    args = ap.parse_args()
+
+    if args.layout:
+        return measure(args)
+    # each layout is measured in a separate process, so memory freed by the other layout does not interfere
+    for layout in ('compact', 'legacy'):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--layout', layout] +
+                                         sys.argv[1:], universal_newlines=True)
+        n_nodes, n_bytes = [int(x) for x in output.split()]
+        print("{:8s} {:7d} nodes {:10.1f} MB {:8.0f} bytes/node".format(
+            layout, n_nodes, n_bytes / 1e6, n_bytes / float(max(n_nodes, 1))))
+
+
+if __name__ == "__main__":
+    main()
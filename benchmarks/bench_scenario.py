@@ -0,0 +1,143 @@
+"""
+Benchmark Scenario.run, calc_scores, to_list and write_sdf on a set of drugs, for several scenarios and
+numbers of cycles, and check that the predicted metabolites, with their scores and pathways, equal those of a saved
+reference run
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import sygma
+from io import StringIO
+from rdkit import Chem, RDLogger
+RDLogger.DisableLog('rdApp.*')
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# {name: function returning the scenario steps [[ruleset name, cycles]] for a number of cycles}
+suites = {
+    'phase1_phase2': lambda cycles: [['phase1', cycles], ['phase2', 1]],
+    'rhea_all': lambda cycles: [['rhea_all', cycles]],
+}
+
+stages = ['run', 'calc_scores', 'to_list', 'write_sdf']
+
+
+def read_smiles(filename):
+    """Return a list of (name, smiles) tuples read from a file with lines 'smiles name'"""
+    parents = []
+    for line in open(filename):
+        if line.strip() and line[0] != "#":
+            smiles, name = (line.split() + [""])[:2]
+            parents.append((name or smiles, smiles))
+    return parents
+
+
+def set_rulesets(args):
+    """Replace the rule files of rulesets with the NAME=PATH pairs of args.ruleset"""
+    for item in args.ruleset:
+        name, path = item.split('=', 1)
+        sygma.ruleset[name] = path
+
+
+def measure(args):
+    """Run one suite with args.cycles[0] cycles on all parents and print the results as JSON"""
+    set_rulesets(args)
+    scenario = sygma.Scenario([[sygma.ruleset[name], cycles] for name, cycles in suites[args.suite](args.cycles[0])])
+    times = dict((stage, 0.0) for stage in stages)
+    n_nodes = 0
+    n_metabolites = 0
+    metabolites = {}
+    for name, smiles in read_smiles(args.smiles):
+        start = time.time()
+        tree = scenario.run(Chem.MolFromSmiles(smiles))
+        times['run'] += time.time() - start
+        start = time.time()
+        tree.calc_scores()
+        times['calc_scores'] += time.time() - start
+        start = time.time()
+        rows = tree.to_list()
+        times['to_list'] += time.time() - start
+        start = time.time()
+        tree.write_sdf(StringIO())
+        times['write_sdf'] += time.time() - start
+        n_nodes += len(tree.nodes)
+        n_metabolites += len(rows)
+        metabolites[name] = sorted([Chem.MolToSmiles(row['SyGMa_metabolite']), round(row['SyGMa_score'], 8),
+                                    row['SyGMa_pathway']] for row in rows)
+    json.dump({'times': times, 'nodes': n_nodes, 'metabolites': n_metabolites,
+               'peak_memory': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+               'predictions': metabolites}, sys.stdout)
+
+
+def compare(reference, predictions):
+    """Return the names of the parents of which the metabolites, their scores or pathways differ from the reference"""
+    return sorted(name for name in set(reference) | set(predictions)
+                  if reference.get(name) != predictions.get(name))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--smiles', help="File with 'smiles name' lines (default: %(default)s)",
+                    default=os.path.join(here, 'drugs.smi'))
+    ap.add_argument('--suite', help="Scenarios to run (default: all)", choices=sorted(suites), action='append')
+    ap.add_argument('--cycles', help="Numbers of cycles of the first step of each scenario (default: 1 2 3)",
+                    type=int, nargs='+', default=[1, 2, 3])
+    ap.add_argument('--ruleset', help="Use the rule file at PATH for ruleset NAME", metavar='NAME=PATH',
+                    action='append', default=[])
+    ap.add_argument('--save', help="Save the predicted metabolites as the reference of later runs to this file")
+    ap.add_argument('--check', help="Check the predicted metabolites against the reference saved in this file")
+    ap.add_argument('--json', help="Write the timings, node counts and peak memory to this file")
+    ap.add_argument('--measure', help=argparse.SUPPRESS, action='store_true')
+    args = ap.parse_args()
+
+    if args.measure:
+        args.suite = args.suite[0]
+        return measure(args)
+
+    set_rulesets(args)
+    reference = json.load(open(args.check)) if args.check else {}
+    results = {}
+    predictions = {}
+    mismatches = 0
+    print("{:20s} {:>8s} {:>12s} {:>10s} {:>10s} {:>10s} {:>8s} {:>11s}".format(
+        'scenario', 'nodes', 'run (s)', 'scores (s)', 'list (s)', 'sdf (s)', 'peak MB', 'equivalence'))
+    for suite in args.suite or sorted(suites):
+        missing = [name for name, cycles in suites[suite](1) if not os.path.exists(sygma.ruleset[name])]
+        if missing:
+            print("{:20s} skipped, no rule file for {}".format(suite, ', '.join(missing)))
+            continue
+        for cycles in args.cycles:
+            label = '{}_{}'.format(suite, cycles)
+            # each run is measured in a separate process, so the peak memory is that of the run
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), '--measure', '--suite', suite, '--cycles', str(cycles),
+                 '--smiles', args.smiles] + ['--ruleset=' + item for item in args.ruleset], universal_newlines=True)
+            result = json.loads(output)
+            predictions[label] = result.pop('predictions')
+            results[label] = result
+            equivalence = ''
+            if label in reference:
+                differences = compare(reference[label], predictions[label])
+                mismatches += len(differences)
+                equivalence = 'differs: ' + ' '.join(differences) if differences else 'same'
+            times = result['times']
+            print("{:20s} {:8d} {:12.2f} {:10.2f} {:10.2f} {:10.2f} {:8.1f} {}".format(
+                label, result['nodes'], times['run'], times['calc_scores'], times['to_list'], times['write_sdf'],
+                result['peak_memory'] / 1e6, equivalence))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(predictions, f, indent=1, sort_keys=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
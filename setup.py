@@ -36,11 +36,15 @@ setup(
                  "Natural Language :: English",
                  "Operating System :: OS Independent",
                  "Topic :: Scientific/Engineering :: Chemistry",
-                 "Programming Language :: Python :: 2.7",
-                 "Programming Language :: Python :: 3.5",
+                 "Programming Language :: Python :: 3",
+                 "Programming Language :: Python :: 3 :: Only",
+                 "Programming Language :: Python :: 3.9",
+                 "Programming Language :: Python :: 3.10",
+                 "Programming Language :: Python :: 3.11",
+                 "Programming Language :: Python :: 3.12",
                  ],
     packages=find_packages(),
-    install_requires=['future'],
+    python_requires='>=3.9',
     package_data={'sygma': ['rules/*.txt']},
-    entry_points={'console_scripts': ['sygma = sygma.script:main']}
+    entry_points={'console_scripts': ['sygma = sygma.script:main', 'sygma-server = sygma.server:main']}
 )
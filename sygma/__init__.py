@@ -1,6 +1,39 @@
-from sygma.scenario import *
-from sygma.tree import *
-from sygma.treenode import *
-from sygma.ruleset import *
+import importlib
+from sygma.ruleset import ruleset
 
 __version__ = '1.1.0_adjusted'
+
+# The submodules are only imported when one of their classes or functions is first used,
+# which keeps ``import sygma`` fast, e.g. for the command line script
+_exports = {
+    'Scenario': 'sygma.scenario',
+    'Rule': 'sygma.scenario',
+    'read_reaction_rules': 'sygma.scenario',
+    'build_rule_cache': 'sygma.scenario',
+    'deduplicate_rules': 'sygma.scenario',
+    'Tree': 'sygma.tree',
+    'read_tree': 'sygma.tree',
+    'TreeNode': 'sygma.treenode',
+    'RuleSets': 'sygma.ruleset',
+    'ResultCache': 'sygma.cache',
+    'TransformationMemo': 'sygma.memo',
+    'TreeStats': 'sygma.stats',
+}
+_submodules = ['scenario', 'tree', 'treenode', 'cache', 'memo', 'stats', 'script', 'server']
+
+__all__ = ['ruleset'] + list(_exports)
+
+
+def __getattr__(name):
+    if name in _exports:
+        value = getattr(importlib.import_module(_exports[name]), name)
+    elif name in _submodules:
+        value = importlib.import_module('sygma.' + name)
+    else:
+        raise AttributeError("module 'sygma' has no attribute '{}'".format(name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports) | set(_submodules))
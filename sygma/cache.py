@@ -0,0 +1,112 @@
+"""Persistent cache of the metabolic trees predicted by a Scenario, in an SQLite database"""
+from rdkit import Chem, rdBase
+from sygma.tree import ruleset_key
+import hashlib
+import os
+import pickle
+import sqlite3
+import time
+import logging
+logger = logging.getLogger('sygma')
+
+RESULT_CACHE_VERSION = 3
+
+
+def result_key(parentmol, scenario, identity="inchikey", **options):
+    """
+    Return the key of the tree of a parent molecule predicted with a scenario
+
+    :param parentmol:
+        An RDKit molecule, identified by its canonical isomeric smiles
+    :param scenario:
+        List of [name, cycles, rules] steps, see :class:`sygma.Scenario`, identified by the contents of the rules
+        and the number of cycles of each step
+    :param identity:
+        Name of the strategy to compute the keys on which metabolites are deduplicated
+    :param options:
+        Other options of the prediction that change the tree, e.g. min_score
+    """
+    sha = hashlib.sha1()
+    sha.update(u'{} {} {}\n'.format(RESULT_CACHE_VERSION, rdBase.rdkitVersion, identity).encode('utf-8'))
+    for name, cycles, rules in scenario:
+        sha.update(u'{} {} {}\n'.format(ruleset_key(rules), cycles,
+                                        [rule.max_products for rule in rules]).encode('utf-8'))
+    sha.update(u'{}\n'.format(sorted(options.items())).encode('utf-8'))
+    return Chem.MolToSmiles(parentmol) + ' ' + sha.hexdigest()
+
+
+class ResultCache(object):
+    """
+    Cache of pickled results in an SQLite database, which removes the least recently used results
+    when the total size of the results exceeds max_size
+
+    :param directory:
+        Directory of the database file, created if it does not exist
+    :param max_size:
+        Maximum total size in bytes of the cached results
+    """
+
+    def __init__(self, directory, max_size=1024 ** 3):
+        self.directory = directory
+        self.filename = os.path.join(directory, 'results.sqlite')
+        self.max_size = max_size
+        self._connection = None
+
+    def __getstate__(self):
+        # connections cannot be pickled, e.g. to worker processes, which open their own connection
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        return state
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self._connection = sqlite3.connect(self.filename, timeout=60)
+            with self._connection:
+                self._connection.execute('CREATE TABLE IF NOT EXISTS results '
+                                         '(key TEXT PRIMARY KEY, value BLOB, size INTEGER, accessed REAL)')
+                self._connection.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+        return self._connection
+
+    def get(self, key):
+        """Return the result stored with key, or None if there is none"""
+        row = self.connection.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        with self.connection:
+            self.connection.execute('UPDATE results SET accessed = ? WHERE key = ?', (time.time(), key))
+        try:
+            return pickle.loads(row[0])
+        except Exception as e:
+            logger.warning('Ignoring unreadable cached result: ' + str(e))
+            return None
+
+    def put(self, key, value):
+        """Store value with key, and remove the least recently used results to stay within max_size"""
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_size:
+            return
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                                    (key, sqlite3.Binary(blob), len(blob), time.time()))
+            total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+            if total > self.max_size:
+                removed = 0
+                for old_key, size in self.connection.execute(
+                        'SELECT key, size FROM results WHERE key != ? ORDER BY accessed', (key,)).fetchall():
+                    self.connection.execute('DELETE FROM results WHERE key = ?', (old_key,))
+                    total -= size
+                    removed += 1
+                    if total <= self.max_size:
+                        break
+                logger.debug('Removed {} results from the cache'.format(removed))
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def clear(self):
+        """Remove all results"""
+        with self.connection:
+            self.connection.execute('DELETE FROM results')
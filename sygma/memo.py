@@ -0,0 +1,44 @@
+"""Memo of the products of rules applied to substrates, which can be shared by trees"""
+from collections import OrderedDict
+
+
+class TransformationMemo(object):
+    """
+    Bounded memo {(substrate key, rule smarts, max products, identity): [(ikey, product as RDKit binary)]},
+    which removes the least recently used entries when it holds more than max_size entries
+
+    :param max_size:
+        Maximum number of entries
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """Return the products stored with key, or None if there are none"""
+        products = self._entries.get(key)
+        if products is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return products
+
+    def put(self, key, products):
+        """Store the products with key, and remove the least recently used entries to stay within max_size"""
+        self._entries[key] = products
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Remove all entries and reset the counters"""
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
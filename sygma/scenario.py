@@ -1,48 +1,293 @@
+from rdkit import Chem, DataStructs, rdBase
 from rdkit.Chem import AllChem
+from sygma.cache import ResultCache, result_key
 from sygma.tree import Tree
+import hashlib
+import itertools
+import os
+import pickle
+import time
 import logging
 logger = logging.getLogger('sygma')
 
+RULE_CACHE_VERSION = 4
 
-def read_reaction_rules(filename):
+
+def rule_cache_dir():
+    """
+    Return the directory with compiled rule files:
+    $SYGMA_CACHE_DIR, or the sygma directory in $XDG_CACHE_HOME or ~/.cache
+    """
+    if os.environ.get('SYGMA_CACHE_DIR'):
+        return os.environ['SYGMA_CACHE_DIR']
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'sygma')
+
+
+def rule_cache_file(filename):
+    """Return the path of the compiled version of a rule file, keyed by the content of the rule file"""
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        sha.update(f.read())
+    sha.update(u'{} {}'.format(RULE_CACHE_VERSION, rdBase.rdkitVersion).encode('utf-8'))
+    return os.path.join(rule_cache_dir(), sha.hexdigest() + '.rules.pkl')
+
+
+def parse_reaction_rules(filename):
+    """
+    Read rules from a file with lines containing tab separated smarts, probability and rulename. Of the other
+    columns, a column max_products=N sets the maximum number of products of the rule (see :class:`Rule`) to the
+    positive integer N, the others are ignored.
+    """
     rules = []
     for l in open(filename, "r"):
         if l != "\n" and l[0] != "#":
-            smarts, probability, name = l.split("\t")[0:3]
-            rules.append(Rule(name, probability, smarts))
+            fields = l.split("\t")
+            smarts, probability, name = fields[0:3]
+            max_products = None
+            for field in fields[3:]:
+                field = field.strip()
+                if field.startswith('max_products='):
+                    value = field[len('max_products='):]
+                    if value.isdigit() and int(value) > 0:
+                        max_products = int(value)
+                    else:
+                        logger.warning('Ignoring {} of rule {} in {}, it is not a positive integer'.format(
+                            field, name.strip(), filename))
+            rules.append(Rule(name, probability, smarts, max_products=max_products))
+    return rules
+
+
+def write_compiled_rules(rules, cache_file):
+    """Write rules with their reactions as RDKit binaries to cache_file"""
+    compiled = [(rule.rulename, rule.probability, rule.smarts, rule.reaction.ToBinary(), rule.screens,
+                 rule.max_products, rule.canonical) for rule in rules]
+    cache_dir = os.path.dirname(cache_file)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(compiled, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)  # atomic, so concurrent processes never read a partial file
+
+
+def read_compiled_rules(cache_file):
+    """Read rules written by write_compiled_rules"""
+    with open(cache_file, 'rb') as f:
+        compiled = pickle.load(f)
+    return [Rule(name, probability, smarts, reaction=AllChem.ChemicalReaction(binary), screens=screens,
+                 max_products=max_products, canonical=canonical)
+            for name, probability, smarts, binary, screens, max_products, canonical in compiled]
+
+
+def read_reaction_rules(filename, use_cache=True, max_products=None):
+    """
+    Read the rules in a rule file
+
+    :param filename:
+        Rule file with lines containing tab separated smarts, probability and rulename, see
+        :func:`parse_reaction_rules`
+    :param use_cache:
+        Boolean to use a compiled version of the rule file from :func:`rule_cache_dir`,
+        which is created if it does not yet exist
+    :param max_products:
+        Integer, maximum number of products of the rules that do not set their own maximum in the rule file
+    :return:
+        A list of rules
+    """
+    if not use_cache:
+        rules = parse_reaction_rules(filename)
+    else:
+        rules = None
+        cache_file = rule_cache_file(filename)
+        if os.path.exists(cache_file):
+            try:
+                rules = read_compiled_rules(cache_file)
+            except Exception as e:
+                logger.warning('Ignoring unreadable compiled rules ' + cache_file + ': ' + str(e))
+        if rules is None:
+            rules = parse_reaction_rules(filename)
+            try:
+                write_compiled_rules(rules, cache_file)
+            except (IOError, OSError) as e:
+                logger.warning('Could not write compiled rules ' + cache_file + ': ' + str(e))
+    if max_products is not None:
+        for rule in rules:
+            if rule.max_products is None:
+                rule.max_products = max_products
     return rules
 
+
+def canonical_reaction_smarts(reaction):
+    """
+    Return the reaction smarts of an RDKit reaction with its atom maps renumbered in order of appearance in the
+    reactant templates, which is the same for rules that differ only in their atom map numbers
+    """
+    reaction = AllChem.ChemicalReaction(reaction)
+    numbers = {}
+    for template in reaction.GetReactants():
+        for atom in template.GetAtoms():
+            if atom.GetAtomMapNum():
+                numbers.setdefault(atom.GetAtomMapNum(), len(numbers) + 1)
+    for template in itertools.chain(reaction.GetReactants(), reaction.GetProducts()):
+        for atom in template.GetAtoms():
+            if atom.GetAtomMapNum():
+                atom.SetAtomMapNum(numbers.get(atom.GetAtomMapNum(), 0))
+    return AllChem.ReactionToSmarts(reaction)
+
+
+def deduplicate_rules(rulesets):
+    """
+    Merge the rules with the same canonical reaction smarts (Rule.canonical) in lists of rules, e.g. the steps of
+    a scenario, into one rule with the highest probability, the highest maximum number of products and the names
+    of all duplicates (Rule.names). The given rules are not changed, merged rules are new Rule objects.
+
+    :param rulesets:
+        List of lists of rules
+    :return:
+        List with for each list of rules the unique rules, in order of first appearance. A transformation that is
+        in several lists is the same Rule object in each of them.
+    """
+    table = {}  # {canonical smarts: rule}
+    n_rules = 0
+    for rule in itertools.chain(*rulesets):
+        n_rules += 1
+        first = table.get(rule.canonical)
+        if first is None:
+            table[rule.canonical] = rule
+        elif first is not rule:
+            table[rule.canonical] = Rule(
+                first.rulename,
+                max(first.probability, rule.probability, key=float),
+                first.smarts, reaction=first.reaction, screens=first.screens,
+                max_products=None if first.max_products is None or rule.max_products is None else
+                max(first.max_products, rule.max_products),
+                names=first.names + [name for name in rule.names if name not in first.names],
+                canonical=first.canonical)
+    if len(table) < n_rules:
+        logger.info('Removed {} duplicate rules, {} unique rules remain'.format(n_rules - len(table), len(table)))
+    unique = []
+    for rules in rulesets:
+        unique.append([])
+        canonicals = set()
+        for rule in rules:
+            if rule.canonical not in canonicals:
+                canonicals.add(rule.canonical)
+                unique[-1].append(table[rule.canonical])
+    return unique
+
+
+def build_rule_cache(names=None):
+    """
+    Compile the rule files of the ruleset entries
+
+    :param names:
+        List of names of ruleset entries, all entries with an existing rule file if None
+    """
+    from sygma.ruleset import ruleset
+    for name in (names if names is not None else sorted(ruleset)):
+        filename = ruleset[name]
+        if not os.path.exists(filename):
+            logger.warning('Skipping ' + name + ', rule file not found: ' + filename)
+            continue
+        rules = parse_reaction_rules(filename)
+        write_compiled_rules(rules, rule_cache_file(filename))
+        logger.info('Compiled {} rules of {}'.format(len(rules), name))
+
 class Scenario(object):
     """
     Class to read and process metabolic scenario
 
     :param scenario:
         A list of lists, each representing a metabolic phase as
-        [name_of_file_containing_rules, number_of_cycles_to_apply]
+        [name_of_file_containing_rules, number_of_cycles_to_apply], optionally followed by the list of rules
+        already read from the file
+    :param identity:
+        Name of the strategy to compute the keys on which metabolites are deduplicated,
+        see :class:`sygma.Tree`
+    :param cache:
+        A :class:`sygma.cache.ResultCache`, or the directory of one, in which the trees predicted by run are kept
+        and looked up before any rule is applied. No cache if None. The trees are kept without their statistics,
+        and a profiled scenario does not look them up, so its trees are always predicted and profiled.
+    :param memo:
+        A :class:`sygma.memo.TransformationMemo` shared by the trees of this and other scenarios, see
+        :class:`sygma.Tree`. No memo if None.
+    :param profile:
+        Boolean to collect the statistics of the trees predicted by run in their stats, see :class:`sygma.Tree`
+    :param deduplicate:
+        Boolean to merge the rules with the same reaction within and across the steps, see
+        :func:`deduplicate_rules`. A rule shared by steps is applied once to each metabolite.
     """
 
-    def __init__(self, scenario):
+    def __init__(self, scenario, identity="inchikey", cache=None, memo=None, profile=False, deduplicate=True):
+        self.identity = identity
+        self.memo = memo
+        self.profile = profile
+        if cache is not None and not isinstance(cache, ResultCache):
+            cache = ResultCache(cache)
+        self.cache = cache
         self.rules = {}
         for step in scenario:
             name = step[0]
-            step.append(read_reaction_rules(name))
+            if len(step) < 3:
+                step.append(read_reaction_rules(name))
+        if deduplicate:
+            for step, rules in zip(scenario, deduplicate_rules([step[2] for step in scenario])):
+                step[2] = rules
         self.scenario = scenario
 
-    def run(self, parentmol):
+    def run(self, parentmol, processes=None, min_score=None, max_nodes_per_cycle=None, max_nodes=None, max_time=None,
+            max_products=None, max_atoms=None):
         """
         :param parentmol:
             An RDKit molecule
+        :param processes:
+            Integer, number of worker processes to metabolize the nodes of each cycle in parallel
+        :param min_score:
+            Metabolites with a score below min_score are not added to the tree, and therefore never metabolized
+        :param max_nodes_per_cycle:
+            Integer, maximum number of new metabolites kept in each cycle, the metabolites with the highest scores
+        :param max_nodes:
+            Integer, maximum number of nodes of the tree
+        :param max_time:
+            Maximum wall time in seconds to metabolize the parent molecule
+        :param max_products:
+            Integer, maximum number of products of each application of a rule
+        :param max_atoms:
+            Integer, maximum number of heavy atoms of metabolites
         :return:
-            A sygma.Tree object
+            A sygma.Tree object, marked as truncated if one of the budgets max_nodes, max_time, max_products or
+            max_atoms ran out, see :meth:`sygma.Tree.metabolize_all_nodes`
         """
+        if self.cache is not None:
+            key = result_key(parentmol, self.scenario, self.identity, min_score=min_score,
+                             max_nodes_per_cycle=max_nodes_per_cycle, max_nodes=max_nodes, max_time=max_time,
+                             max_products=max_products, max_atoms=max_atoms)
+            tree = None if self.profile else self.cache.get(key)
+            if tree is not None:
+                logger.info('Using cached metabolites of ' + key.split(' ')[0])
+                return tree
+        start = time.time()
         if parentmol.GetNumConformers() == 0:
             # make sure the parentmolecule has coordinates
             AllChem.Compute2DCoords(parentmol)
-        tree = Tree(parentmol)
+        tree = Tree(parentmol, identity=self.identity, memo=self.memo, profile=self.profile)
+        tree.metadata['scenario'] = [[name, cycles] for name, cycles, rules in self.scenario]
         for name, cycles, rules in self.scenario:
             logger.info('Applying rules: ' + name)
-            tree.metabolize_all_nodes(rules, cycles)
-        tree.add_coordinates()
+            stopped = tree.metabolize_all_nodes(rules, cycles, processes=processes, min_score=min_score,
+                                                max_nodes_per_cycle=max_nodes_per_cycle, max_nodes=max_nodes,
+                                                max_time=None if max_time is None else max_time - (time.time() - start),
+                                                max_products=max_products, max_atoms=max_atoms)
+            # the later steps cannot add nodes once the node or time budget ran out, unlike the budgets of
+            # max_products and max_atoms that only leave out some products
+            if stopped:
+                break
+        # a tree cut short by the time budget depends on the speed of this run, it is not cached
+        if self.cache is not None and not (tree.truncated and max_time is not None):
+            # the statistics are of this run only
+            stats, tree.stats = tree.stats, None
+            self.cache.put(key, tree)
+            tree.stats = stats
         return tree
 
 
@@ -56,9 +301,42 @@ class Rule(object):
         A probability value between 0 and 1 indicating the empirical success rate of the rule
     :param smarts:
         A reaction smarts describing the chemical transformation of the rule
+    :param reaction:
+        The RDKit reaction compiled from smarts, parsed from smarts if not given
+    :param screens:
+        The pattern fingerprints of the reactant templates of the reaction, computed if not given
+    :param max_products:
+        Integer, maximum number of products of RDKit's RunReactants (maxProducts) for each combination of
+        reactants the rule is applied to, RDKit's default if None
+    :param names:
+        List with the names of the rules merged into this rule, see :func:`deduplicate_rules`, [rulename] if None
+    :param canonical:
+        The canonical reaction smarts of the reaction, see :func:`canonical_reaction_smarts`, computed if not given
     """
 
-    def __init__(self, rulename, probability, smarts):
+    def __init__(self, rulename, probability, smarts, reaction=None, screens=None, max_products=None, names=None,
+                 canonical=None):
         self.rulename = rulename
         self.probability = probability
-        self.reaction = AllChem.ReactionFromSmarts(smarts)
+        self.smarts = smarts
+        self.max_products = max_products
+        self.names = names if names is not None else [rulename]
+        self.reaction = reaction if reaction is not None else AllChem.ReactionFromSmarts(smarts)
+        # substructure screening fingerprints of the reactant templates
+        self.screens = screens if screens is not None else \
+            [Chem.PatternFingerprint(template) for template in self.reaction.GetReactants()]
+        self.canonical = canonical if canonical is not None else canonical_reaction_smarts(self.reaction)
+
+    def can_match(self, fingerprints):
+        """
+        Screen whether the rule can apply to a set of reactants
+
+        :param fingerprints:
+            List with the pattern fingerprints (Chem.PatternFingerprint) of the reactants
+        :return:
+            False if a reactant template of the rule is certainly not a substructure of any of the reactants
+        """
+        for screen in self.screens:
+            if not any(DataStructs.AllProbeBitsMatch(screen, fp) for fp in fingerprints):
+                return False
+        return True
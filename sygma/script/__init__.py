@@ -1,29 +1,149 @@
 """SyGMa: Systematically Generating potential Metabolites"""
 
-from builtins import str
 import argparse
+import multiprocessing
 import sygma
 import sys
+import time
+from io import StringIO
 from rdkit import Chem, RDLogger
 RDLogger.logger().setLevel(RDLogger.ERROR)
 import logging
 logging.basicConfig()
 logger = logging.getLogger('sygma')
 
-def run_sygma(args, file=sys.stdout):
-    logger.setLevel(args.loglevel.upper())
-    scenario = sygma.Scenario([
+def get_scenario(args):
+    return sygma.Scenario([
         [sygma.ruleset['phase1'], args.phase1],
         [sygma.ruleset['phase2'], args.phase2]
-    ])
+    ], cache=getattr(args, 'cache', None), profile=bool(getattr(args, 'profile', None)))
+
+def write_metabolites(metabolic_tree, outputtype, file, parent_id=None):
+    """Write the metabolites of a scored tree as sdf or smiles, optionally labelled with the id of the parent"""
+    if outputtype == "sdf":
+        metabolic_tree.write_sdf(file, properties=None if parent_id is None else {'parent_id': parent_id})
+    elif outputtype == "smiles":
+        metabolic_tree.write_smiles(file, properties=None if parent_id is None else {'parent_id': parent_id})
+
+def run_sygma(args, file=sys.stdout):
+    logger.setLevel(args.loglevel.upper())
+    if getattr(args, 'input', None):
+        return run_sygma_batch(args, file)
+    scenario = get_scenario(args)
 
     parent = Chem.MolFromSmiles(args.parentmol)
     metabolic_tree = scenario.run(parent)
     metabolic_tree.calc_scores()
-    if args.outputtype == "sdf":
-        metabolic_tree.write_sdf(file)
-    elif args.outputtype == "smiles":
-        file.write("\n".join([m+" "+str(s) for m,s in metabolic_tree.to_smiles()])+'\n')
+    write_metabolites(metabolic_tree, args.outputtype, file)
+    if getattr(args, 'profile', None):
+        write_profile(metabolic_tree.stats, args.profile)
+    return None
+
+def write_profile(stats, filename):
+    """Write the statistics collected with the --profile option as JSON, empty statistics if stats is None"""
+    if stats is None:
+        stats = sygma.TreeStats()
+    with open(filename, 'w') as f:
+        stats.write_json(f)
+
+def read_parents(filename):
+    """
+    Generate (parent_id, molecule) tuples from an SDF file or a file with lines 'smiles [id]',
+    where '-' reads smiles from stdin. Molecules without a name get their sequence number as id.
+    """
+    if filename.lower().endswith('.sdf'):
+        with open(filename, 'rb') as f:
+            for i, mol in enumerate(Chem.ForwardSDMolSupplier(f)):
+                if mol is None:
+                    logger.warning('Skipping unreadable molecule ' + str(i + 1))
+                    continue
+                yield (mol.GetProp('_Name') if mol.HasProp('_Name') and mol.GetProp('_Name') else str(i + 1)), mol
+    elif filename == '-':
+        for parent in read_smiles_lines(sys.stdin):
+            yield parent
+    else:
+        with open(filename) as f:
+            for parent in read_smiles_lines(f):
+                yield parent
+
+def read_smiles_lines(lines):
+    """Generate (parent_id, molecule) tuples from lines 'smiles [id]', see read_parents"""
+    for i, line in enumerate(lines):
+        fields = line.split()
+        if len(fields) == 0 or fields[0][0] == '#':
+            continue
+        mol = Chem.MolFromSmiles(fields[0])
+        if mol is None:
+            logger.warning('Skipping unreadable smiles ' + fields[0])
+            continue
+        yield (fields[1] if len(fields) > 1 else str(i + 1)), mol
+
+_scenario = None
+
+def _init_worker(scenario, loglevel):
+    """Set the scenario once in each worker process"""
+    global _scenario
+    RDLogger.logger().setLevel(RDLogger.ERROR)
+    logger.setLevel(loglevel.upper())
+    _scenario = scenario
+
+def _predict(task):
+    """
+    Predict and score the metabolites of one parent and return them formatted as text,
+    with the statistics of the tree if the scenario is profiled.
+    A parent that fails is logged and gives no metabolites, so the other parents of the batch are still predicted.
+    """
+    parent_id, mol, outputtype = task
+    try:
+        metabolic_tree = _scenario.run(mol)
+        metabolic_tree.calc_scores()
+        out = StringIO()
+        write_metabolites(metabolic_tree, outputtype, out, parent_id=parent_id)
+    except Exception as e:
+        logger.error('Could not predict the metabolites of {}: {}: {}'.format(parent_id, type(e).__name__, e))
+        return "", None
+    return out.getvalue(), metabolic_tree.stats
+
+def run_sygma_batch(args, file=sys.stdout):
+    """Predict the metabolites of all parents in args.input, in args.jobs worker processes"""
+    start = time.time()
+    tasks = ((parent_id, mol, args.outputtype) for parent_id, mol in read_parents(args.input))
+    jobs = getattr(args, 'jobs', 1)
+    # the rules are read in the main process, so errors are raised here rather than in each worker
+    scenario = get_scenario(args)
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(scenario, args.loglevel))
+        results = pool.imap_unordered(_predict, tasks)
+    else:
+        _init_worker(scenario, args.loglevel)
+        results = (_predict(task) for task in tasks)
+    n = 0
+    profile = None
+    try:
+        for text, stats in results:
+            # write the metabolites of each parent as soon as it is finished
+            file.write(text)
+            file.flush()
+            n += 1
+            if stats is not None:
+                if profile is None:
+                    profile = stats
+                else:
+                    profile.update(stats)
+    except BaseException:
+        # on an error or Ctrl-C the workers may still be busy, close() would wait for all of them
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if getattr(args, 'profile', None):
+        write_profile(profile, args.profile)
+    elapsed = time.time() - start
+    logger.info('Processed {} parents in {:.1f} s ({:.2f} parents/s)'.format(n, elapsed, n / elapsed if elapsed else 0.0))
     return None
 
 def get_sygma_parser():
@@ -34,7 +154,17 @@ def get_sygma_parser():
     ap.add_argument('-2', '--phase2', help="Number of phase 2 cycles (default: %(default)s)", default=1, type=int)
     ap.add_argument('-l', '--loglevel', help="Set logging level (default: %(default)s)", default='info',
                     choices=['debug', 'info', 'warn',' error'])
-    ap.add_argument('parentmol', help="Smiles string of parent molecule structure", type=str)
+    ap.add_argument('-i', '--input', help="Batch mode: file with parent molecules, either SDF (.sdf) or lines "
+                    "'smiles [id]', or - to read smiles from stdin", type=str)
+    ap.add_argument('-j', '--jobs', help="Number of worker processes in batch mode (default: %(default)s)",
+                    default=1, type=int)
+    ap.add_argument('--cache', help="Directory of a persistent cache of predicted metabolites, which is used "
+                    "for parents predicted before with the same options", type=str)
+    ap.add_argument('--profile', help="Write the time spent in each stage and on each rule as JSON to this file",
+                    type=str)
+    ap.add_argument('--build-rule-cache', help="Compile the rule files of all rulesets and exit",
+                    action='store_true')
+    ap.add_argument('parentmol', help="Smiles string of parent molecule structure", type=str, nargs='?')
     return ap
 
 def main():
@@ -43,6 +173,11 @@ def main():
     # Parse arguments and run subcommand
     ap = get_sygma_parser()
     args = ap.parse_args(sys.argv[1:])
+    if args.build_rule_cache:
+        logger.setLevel(args.loglevel.upper())
+        return sygma.build_rule_cache()
+    if args.parentmol is None and args.input is None:
+        ap.error('either a parentmol or an --input file is required')
     return run_sygma(args)
 
 if __name__ == "__main__":
@@ -0,0 +1,244 @@
+"""
+SyGMa server: predict metabolites over HTTP with JSON requests, keeping the rules of named scenarios
+in memory in a pool of worker processes
+"""
+import argparse
+import json
+import os
+import sygma
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from rdkit import Chem, RDLogger
+from sygma.scenario import Scenario, deduplicate_rules, read_reaction_rules
+RDLogger.logger().setLevel(RDLogger.ERROR)
+import logging
+logging.basicConfig()
+logger = logging.getLogger('sygma')
+
+# Options of a request that are passed on to Scenario.run
+RUN_OPTIONS = ['min_score', 'max_nodes_per_cycle', 'max_nodes', 'max_time', 'max_products', 'max_atoms']
+
+_scenarios = None
+
+
+def read_scenarios(definitions):
+    """
+    Read the rules of named scenarios
+
+    :param definitions:
+        Dictionary {name: [[ruleset name or rule file, default number of cycles]]}
+    :return:
+        Dictionary {name: [[rule file, default number of cycles, rules]]}, where each rule file is read once and
+        the rules of each scenario are deduplicated (see :func:`sygma.scenario.deduplicate_rules`)
+    """
+    rules = {}
+    scenarios = {}
+    for name, steps in definitions.items():
+        scenarios[name] = []
+        for ruleset, cycles in steps:
+            filename = sygma.ruleset[ruleset] if ruleset in sygma.ruleset else ruleset
+            if filename not in rules:
+                rules[filename] = read_reaction_rules(filename)
+            scenarios[name].append([filename, cycles, rules[filename]])
+        for step, unique in zip(scenarios[name], deduplicate_rules([step[2] for step in scenarios[name]])):
+            step[2] = unique
+    return scenarios
+
+
+def _init_worker(scenarios, loglevel):
+    """Set the scenarios once in each worker process"""
+    global _scenarios
+    RDLogger.logger().setLevel(RDLogger.ERROR)
+    logger.setLevel(loglevel.upper())
+    _scenarios = scenarios
+
+
+def predict(request):
+    """
+    Predict the metabolites of one parent molecule
+
+    :param request:
+        Dictionary with the smiles of the parent molecule and optionally its id, the name of the scenario
+        (default: "default"), the cycles of each step of the scenario, the output ("json", "smiles" or "sdf",
+        default: "json"), top_n and the options of :meth:`sygma.Scenario.run` in RUN_OPTIONS
+    :return:
+        Dictionary with the id and smiles of the request, whether the tree was truncated, and the metabolites as
+        a list of {smiles, score, pathway} dictionaries if the output is json or as text otherwise.
+        Or a dictionary with the error if the request could not be handled.
+    """
+    result = {'id': request.get('id'), 'smiles': request.get('smiles')}
+    try:
+        mol = Chem.MolFromSmiles(request['smiles'])
+        if mol is None:
+            raise ValueError('Invalid smiles: ' + request['smiles'])
+        name = request.get('scenario', 'default')
+        if name not in _scenarios:
+            raise ValueError('Unknown scenario: ' + name)
+        steps = _scenarios[name]
+        cycles = request.get('cycles', [cycles for filename, cycles, rules in steps])
+        if len(cycles) != len(steps):
+            raise ValueError('Scenario {} has {} steps, not {}'.format(name, len(steps), len(cycles)))
+        scenario = Scenario([[filename, int(n), rules] for (filename, default, rules), n in zip(steps, cycles)],
+                            deduplicate=False)
+        tree = scenario.run(mol, **dict((option, request[option]) for option in RUN_OPTIONS if option in request))
+        tree.calc_scores()
+        result['truncated'] = tree.truncated
+        output = request.get('output', 'json')
+        if output == 'json':
+            result['metabolites'] = [{'smiles': Chem.MolToSmiles(row['SyGMa_metabolite']),
+                                      'score': row['SyGMa_score'],
+                                      'pathway': row['SyGMa_pathway']}
+                                     for row in tree.iter_metabolites(top_n=request.get('top_n'))]
+        elif output in ('smiles', 'sdf'):
+            out = StringIO()
+            properties = None if request.get('id') is None else {'parent_id': request['id']}
+            if output == 'sdf':
+                tree.write_sdf(out, properties=properties, top_n=request.get('top_n'))
+            else:
+                tree.write_smiles(out, properties=properties, top_n=request.get('top_n'))
+            result['metabolites'] = out.getvalue()
+        else:
+            raise ValueError('Unknown output: ' + str(output))
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    return result
+
+
+class SygmaRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handle GET /scenarios, which lists the scenarios with their default cycles, and POST /predict with a JSON
+    request (see :func:`predict`), a list of requests or {"requests": [requests]}. The requests of a list are
+    predicted in parallel and answered with a list of results in the same order. A post is answered with status
+    500 and an error if a worker process died while predicting it.
+    """
+
+    def do_GET(self):
+        if self.path == '/scenarios':
+            self.send_json(200, dict((name, [[filename, cycles] for filename, cycles, rules in steps])
+                                     for name, steps in self.server.scenarios.items()))
+        else:
+            self.send_json(404, {'error': 'Not found: ' + self.path})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            return self.send_json(404, {'error': 'Not found: ' + self.path})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+        except ValueError as e:
+            return self.send_json(400, {'error': 'Invalid JSON: ' + str(e)})
+        if isinstance(body, dict) and 'requests' in body:
+            body = body['requests']
+        if isinstance(body, list):
+            if not all(isinstance(request, dict) for request in body):
+                return self.send_json(400, {'error': 'Requests must be JSON objects'})
+        elif not isinstance(body, dict):
+            return self.send_json(400, {'error': 'A request must be a JSON object'})
+        executor = self.server.executor
+        try:
+            if isinstance(body, list):
+                results = list(executor.map(predict, body))
+            else:
+                results = executor.submit(predict, body).result()
+        except BrokenProcessPool as e:
+            # a worker process died, e.g. killed when out of memory, the requests of this and of concurrent
+            # posts fail, later posts are predicted by new workers
+            logger.error('Restarting the worker processes after a worker died: ' + str(e))
+            self.server.restart_executor(executor)
+            return self.send_json(500, {'error': 'A worker process died: {}'.format(e)})
+        self.send_json(200, results)
+
+    def send_json(self, status, data):
+        content = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class SygmaServer(ThreadingHTTPServer):
+    """
+    HTTP server predicting metabolites in a pool of worker processes
+
+    :param address:
+        Tuple (host, port)
+    :param scenarios:
+        Dictionary {name: [[rule file, default number of cycles, rules]]}, see :func:`read_scenarios`
+    :param jobs:
+        Number of worker processes, which bounds the number of parents predicted at the same time
+    """
+    daemon_threads = True
+
+    def __init__(self, address, scenarios, jobs=1, loglevel='info'):
+        ThreadingHTTPServer.__init__(self, address, SygmaRequestHandler)
+        self.scenarios = scenarios
+        self.jobs = jobs
+        self.loglevel = loglevel
+        self._executor_lock = threading.Lock()
+        self.executor = self._start_executor()
+
+    def _start_executor(self):
+        return ProcessPoolExecutor(self.jobs, initializer=_init_worker, initargs=(self.scenarios, self.loglevel))
+
+    def restart_executor(self, broken):
+        """
+        Replace the pool of worker processes broken by the death of a worker with a new pool, unless another
+        request handler replaced it already
+        """
+        with self._executor_lock:
+            if self.executor is broken:
+                broken.shutdown(wait=False)
+                self.executor = self._start_executor()
+
+    def server_close(self):
+        ThreadingHTTPServer.server_close(self)
+        self.executor.shutdown()
+
+
+def parse_scenario(definition):
+    """Parse a scenario definition NAME=RULESET:CYCLES[,RULESET:CYCLES...] into (name, [[ruleset, cycles]])"""
+    name, steps = definition.split('=', 1)
+    return name, [[step.rsplit(':', 1)[0], int(step.rsplit(':', 1)[1]) if ':' in step else 1]
+                  for step in steps.split(',')]
+
+
+def get_server_parser():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--version', action='version', version='%(prog)s ' + sygma.__version__)
+    ap.add_argument('--host', help="Host name or address to listen on (default: %(default)s)", default='127.0.0.1')
+    ap.add_argument('--port', help="Port to listen on (default: %(default)s)", default=8080, type=int)
+    ap.add_argument('-j', '--jobs', help="Number of worker processes (default: number of CPUs)",
+                    default=os.cpu_count(), type=int)
+    ap.add_argument('-s', '--scenario', help="Named scenario of rulesets or rule files with their default number of "
+                    "cycles, e.g. default=phase1:1,phase2:1 (the default scenario if none is given)",
+                    metavar='NAME=RULESET:CYCLES[,RULESET:CYCLES...]', action='append', default=[])
+    ap.add_argument('-l', '--loglevel', help="Set logging level (default: %(default)s)", default='info',
+                    choices=['debug', 'info', 'warn', 'error'])
+    return ap
+
+
+def main():
+    """Entry point for the sygma-server script"""
+    args = get_server_parser().parse_args()
+    logger.setLevel(args.loglevel.upper())
+    definitions = dict(parse_scenario(definition) for definition in args.scenario or ['default=phase1:1,phase2:1'])
+    # the rules are read in the main process, so errors are raised here rather than in each worker
+    server = SygmaServer((args.host, args.port), read_scenarios(definitions), jobs=args.jobs, loglevel=args.loglevel)
+    logger.info('Serving scenarios {} on http://{}:{}/ with {} workers'.format(
+        ', '.join(sorted(definitions)), args.host, server.server_address[1], args.jobs))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
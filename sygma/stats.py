@@ -0,0 +1,66 @@
+"""Counters and timings of the stages of building and analysing a metabolic tree, and of each rule"""
+import json
+
+# Stages of the Tree methods that are timed
+STAGES = {
+    'screen': 'pattern fingerprints of the reactants and screening of the rules',
+    'react': "RDKit's RunReactants",
+    'fragments': 'marking of original atoms, splitting and deduplication of products',
+    'sanitize': 'sanitization of products',
+    'ikey': 'identity keys of products',
+    'memo': 'products found in the memo',
+    'add': 'adding products to the tree',
+    'scores': 'calc_scores',
+    'coords': 'coordinates of metabolites',
+}
+
+
+class TreeStats(object):
+    """
+    Counters and timings of a tree, see Tree.stats
+
+    :key stages:
+        Dictionary {stage: [calls, seconds]}, see STAGES
+    :key rules:
+        Dictionary {rulename: [calls, matches, products, seconds]}: the number of times the rule was applied to
+        reactants that passed screening, the number of outcomes of RunReactants, the number of distinct
+        products and the time spent on applying the rule and computing the keys of its products
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.rules = {}
+
+    def add_stage(self, stage, seconds, calls=1):
+        counts = self.stages.setdefault(stage, [0, 0.0])
+        counts[0] += calls
+        counts[1] += seconds
+
+    def add_rule(self, rulename, calls=0, matches=0, products=0, seconds=0.0):
+        counts = self.rules.setdefault(rulename.strip(), [0, 0, 0, 0.0])
+        counts[0] += calls
+        counts[1] += matches
+        counts[2] += products
+        counts[3] += seconds
+
+    def update(self, other):
+        """Add the counters and timings of other TreeStats"""
+        for stage, (calls, seconds) in other.stages.items():
+            self.add_stage(stage, seconds, calls)
+        for rulename, counts in other.rules.items():
+            self.add_rule(rulename, *counts)
+
+    def to_dict(self):
+        """Return the statistics as a dictionary, with the rules in order of decreasing time"""
+        return {
+            'stages': dict((stage, {'calls': calls, 'seconds': seconds})
+                           for stage, (calls, seconds) in self.stages.items()),
+            'rules': [{'rule': rulename, 'calls': calls, 'matches': matches, 'products': products,
+                       'seconds': seconds}
+                      for rulename, (calls, matches, products, seconds) in
+                      sorted(self.rules.items(), key=lambda item: item[1][3], reverse=True)],
+        }
+
+    def write_json(self, file):
+        """Write the statistics as JSON to a file object"""
+        json.dump(self.to_dict(), file, indent=1)
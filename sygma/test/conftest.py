@@ -0,0 +1,8 @@
+import pytest
+
+
+@pytest.fixture
+def cache_tmpdir(tmp_path, monkeypatch):
+    """A temporary directory, of which the cache subdirectory is used for compiled rule files"""
+    monkeypatch.setenv('SYGMA_CACHE_DIR', str(tmp_path / 'cache'))
+    return str(tmp_path)
@@ -2,7 +2,7 @@ import sygma
 from rdkit import Chem
 
 
-def test_predict_phenol_metabolites():
+def test_predict_phenol_metabolites(cache_tmpdir):
     """Test prediction of phenol metabolites by sygma module"""
 
     # Each step in a scenario lists the ruleset and the number of reaction cycles to be applied
@@ -6,7 +6,7 @@ except ImportError:
     from io import StringIO
 
 
-def test_sygma_command_line1():
+def test_sygma_command_line1(cache_tmpdir):
     """Test prediction of phenol metabolites by sygma command, output smiles"""
 
     args = argparse.Namespace()
@@ -19,7 +19,7 @@ def test_sygma_command_line1():
     sygma.script.run_sygma(args, out)
     assert len(out.getvalue().split('\n')) == 28
 
-def test_sygma_command_line2():
+def test_sygma_command_line2(cache_tmpdir):
     """Test prediction of phenol metabolites by sygma command, output sdf"""
 
     args = argparse.Namespace()
@@ -31,3 +31,21 @@ def test_sygma_command_line2():
     out = StringIO()
     sygma.script.run_sygma(args, out)
     assert len(out.getvalue().split('$$$$\n')) == 4
+
+def test_sygma_command_line_batch(tmp_path, cache_tmpdir):
+    """Test prediction of metabolites of a file with parent molecules by sygma command, output smiles"""
+
+    parents = tmp_path / 'parents.smi'
+    with open(str(parents), 'w') as f:
+        f.write('c1ccccc1O phenol\nc1ccccc1N aniline\n')
+    args = argparse.Namespace()
+    args.phase1 = 1
+    args.phase2 = 0
+    args.input = str(parents)
+    args.jobs = 2
+    args.outputtype = 'smiles'
+    args.loglevel = 'INFO'
+    out = StringIO()
+    sygma.script.run_sygma(args, out)
+    lines = out.getvalue().split('\n')[:-1]
+    assert set(line.split()[-1] for line in lines) == set(['phenol', 'aniline'])
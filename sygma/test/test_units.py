@@ -1,4 +1,9 @@
 import sygma
+import os
+import pytest
+import subprocess
+import sys
+from io import StringIO
 from rdkit import Chem, Geometry
 from rdkit.Chem import AllChem
 
@@ -34,3 +39,466 @@ def test_treenode_gen_coords():
     # test if additional coordinates are generated in gen_coords method
     conf = node.mol.GetConformer(0)
     assert conf.GetAtomPosition(6).x != 0.0
+
+def test_tree_metabolize_frontier():
+    """Test that nodes are metabolized only once with the same rules"""
+
+    rules = [sygma.Rule('aromatic_hydroxylation', '0.2', '[cH:1]>>[c:1]O')]
+    tree = sygma.Tree(Chem.MolFromSmiles('c1ccccc1O'))
+    tree.metabolize_all_nodes(rules, 1)
+    n_nodes = len(tree.nodes)
+    children = set(tree.nodes[tree.parentkey].children)
+
+    # a second cycle only metabolizes the new nodes, the parent node is not expanded again
+    tree.metabolize_all_nodes(rules, 1)
+    assert tree.nodes[tree.parentkey].children == children
+    assert len(tree.nodes) > n_nodes
+    assert len(tree.expanded[sygma.tree.ruleset_key(rules)]) == n_nodes
+
+def test_tree_identity():
+    """Test the identity strategies on which metabolites are deduplicated"""
+
+    mol = Chem.MolFromSmiles('c1ccccc1O')
+    assert sygma.Tree(mol).parentkey == "ISWSIDIOOBJBQZ"
+    assert sygma.Tree(mol, identity="smiles").parentkey == "Oc1ccccc1"
+
+def test_rule_can_match():
+    """Test screening of rules with the pattern fingerprints of reactants"""
+
+    rule = sygma.Rule('O-glucuronidation', '0.5', '[c:1][OH:2]>>[c:1][O:2]C1OC(C(=O)O)C(O)C(O)C1O')
+    assert rule.can_match([Chem.PatternFingerprint(Chem.MolFromSmiles('c1ccccc1O'))])
+    assert not rule.can_match([Chem.PatternFingerprint(Chem.MolFromSmiles('CCCC'))])
+
+def test_batch_predict_error():
+    """Test that a parent that fails in batch mode is skipped without stopping the batch"""
+
+    class FailingScenario(object):
+        def run(self, mol):
+            raise ValueError('failed')
+
+    sygma.script._init_worker(FailingScenario(), 'error')
+    assert sygma.script._predict(('parent', Chem.MolFromSmiles('c1ccccc1O'), 'smiles')) == ("", None)
+
+def test_read_compiled_rules(cache_tmpdir):
+    """Test that rules read from the compiled rule cache equal the rules parsed from the rule file"""
+
+    rulefile = os.path.join(cache_tmpdir, 'rules.txt')
+    with open(rulefile, 'w') as f:
+        f.write('# smarts\tprobability\tname\n')
+        f.write('[c:1][OH:2]>>[c:1][O:2]S(=O)(=O)O\t0.3\tsulfation\n')
+        f.write('[cH:1]>>[c:1]O\t0.2\taromatic_hydroxylation\n')
+    parsed = sygma.read_reaction_rules(rulefile)
+    assert os.path.exists(sygma.scenario.rule_cache_file(rulefile))
+    compiled = sygma.read_reaction_rules(rulefile)
+    assert [(r.rulename, r.probability, AllChem.ReactionToSmarts(r.reaction)) for r in compiled] == \
+        [(r.rulename, r.probability, AllChem.ReactionToSmarts(r.reaction)) for r in parsed]
+
+def test_parse_reaction_rules_columns(cache_tmpdir, caplog):
+    """Test that only a max_products=N column limits the products of a rule, other columns are ignored"""
+
+    rulefile = os.path.join(cache_tmpdir, 'rules.txt')
+    with open(rulefile, 'w') as f:
+        f.write('[cH:1]>>[c:1]O\t0.2\taromatic_hydroxylation\tsee reference 12\n')
+        f.write('[c:1][OH:2]>>[c:1][O:2]S(=O)(=O)O\t0.3\tsulfation\t5\n')
+        f.write('[c:1][OH:2]>>[c:1][O:2]C\t0.1\tO-methylation\tmax_products=2\n')
+        f.write('[#6:1][O:2][CH3:3]>>[#6:1][OH:2]\t0.3\tO-demethylation\tmax_products=none\n')
+    with caplog.at_level('WARNING', logger='sygma'):
+        rules = sygma.read_reaction_rules(rulefile)
+    assert [rule.rulename for rule in rules] == ['aromatic_hydroxylation', 'sulfation', 'O-methylation',
+                                                 'O-demethylation']
+    assert [rule.max_products for rule in rules] == [None, None, 2, None]
+    assert 'max_products=none' in caplog.text
+
+def test_lazy_import():
+    """Test that importing sygma does not import RDKit or pkg_resources before they are needed"""
+
+    code = "import sys, sygma; sygma.ruleset['phase1']; print(sorted(set(['rdkit', 'pkg_resources']) & set(sys.modules)))"
+    assert subprocess.check_output([sys.executable, '-c', code]).strip() == b'[]'
+
+def test_tree_metabolize_parallel():
+    """Test that metabolizing nodes in worker processes gives the same tree as a serial run"""
+
+    rules = [sygma.Rule('aromatic_hydroxylation', '0.2', '[cH:1]>>[c:1]O'),
+             sygma.Rule('sulfation', '0.3', '[c:1][OH:2]>>[c:1][O:2]S(=O)(=O)O')]
+    trees = []
+    for processes in (None, 2):
+        tree = sygma.Tree(Chem.MolFromSmiles('c1ccccc1O'))
+        tree.metabolize_all_nodes(rules, 2, processes=processes)
+        trees.append(tree)
+    assert list(trees[0].nodes) == list(trees[1].nodes)
+    for key, node in trees[0].nodes.items():
+        assert node.uniqueIdent == trees[1].nodes[key].uniqueIdent
+        assert list(node.parents) == list(trees[1].nodes[key].parents)
+
+def test_tree_metabolize_pruning():
+    """Test that metabolites below min_score are not added and at most max_nodes_per_cycle are kept"""
+
+    rules = [sygma.Rule('aromatic_hydroxylation', '0.2', '[cH:1]>>[c:1]O'),
+             sygma.Rule('sulfation', '0.3', '[c:1][OH:2]>>[c:1][O:2]S(=O)(=O)O')]
+    tree = sygma.Tree(Chem.MolFromSmiles('c1ccccc1O'))
+    tree.metabolize_all_nodes(rules, 2, min_score=0.1)
+    assert min(node.score for node in tree.nodes.values()) >= 0.1
+
+    tree = sygma.Tree(Chem.MolFromSmiles('c1ccccc1O'))
+    tree.metabolize_all_nodes(rules, 1, max_nodes_per_cycle=1)
+    assert len(tree.nodes) == 2
+    assert [tree.keys[idx] for idx in tree.nodes[tree.parentkey].children] == \
+        [key for key in tree.nodes if key != tree.parentkey]
+
+def test_tree_iter_metabolites():
+    """Test generating the top scoring metabolites"""
+
+    rules = [sygma.Rule('aromatic_hydroxylation', '0.2', '[cH:1]>>[c:1]O'),
+             sygma.Rule('sulfation', '0.3', '[c:1][OH:2]>>[c:1][O:2]S(=O)(=O)O')]
+    tree = sygma.Tree(Chem.MolFromSmiles('c1ccccc1O'))
+    tree.metabolize_all_nodes(rules, 2)
+    tree.calc_scores()
+    metabolites = tree.to_list(filter_small_fragments=False)
+    top = list(tree.iter_metabolites(filter_small_fragments=False, top_n=3))
+    assert [m['SyGMa_pathway'] for m in top] == [m['SyGMa_pathway'] for m in metabolites[:3]]
+    assert [m['SyGMa_score'] for m in tree.iter_metabolites(filter_small_fragments=False, min_score=0.2)] == [1, 0.3, 0.2, 0.2, 0.2]
+
+def test_tree_n_original_atoms():
+    """Test that n_original_atoms counts the atoms of metabolites that originate from the parent"""
+
+    rules = [sygma.Rule('sulfation', '0.3', '[c:1][OH:2]>>[c:1][O:2]S(=O)(=O)O')]
+    tree = sygma.Tree(Chem.MolFromSmiles('c1ccccc1O'))
+    tree.metabolize_all_nodes(rules, 1)
+    assert [(node.mol.GetNumAtoms(), node.n_original_atoms) for node in tree.nodes.values()] == [(7, 7), (11, 7)]
+    # no coordinates are generated before the metabolites are written
+    assert all(node.mol.GetNumConformers() == 0 for node in tree.nodes.values())
+
+def test_tree_calc_scores_deep():
+    """Test scoring of a deep tree with a cycle, beyond the recursion limit"""
+
+    mol = Chem.MolFromSmiles('CO')
+    tree = sygma.Tree(mol)
+    tree.rules.append(sygma.Rule('hydroxylation', '0.9', '[C:1]>>[C:1]O'))
+    for i in range(sys.getrecursionlimit() + 10):
+        tree.nodes[str(i)] = sygma.TreeNode(mol, parent=len(tree.keys) - 1, rule=0, uniqueIdent=0, ikey=str(i),
+                                            index=len(tree.keys))
+        tree.keys.append(str(i))
+    pkey = tree.keys[-1]
+    tree.nodes['5'].parents[len(tree.keys) - 1] = 0
+    tree.calc_scores()
+    assert abs(tree.nodes['5'].score - 0.9 ** 6) < 1e-12
+    assert abs(tree.nodes[pkey].score / 0.9 ** (int(pkey) + 1) - 1) < 1e-9
+    assert tree.nodes['5'].pathway == 'hydroxylation;' * 6
+
+def test_tree_small_fragments():
+    """Test filtering of small fragments and their descendants"""
+
+    rules = [sygma.Rule('O-demethylation', '0.3', '[c:1][O:2][CH3:3]>>[c:1][O:2].[CH3:3]O'),
+             sygma.Rule('O-glucuronidation', '0.5', '[C:1][OH:2]>>[C:1][O:2]C1OC(C(=O)O)C(O)C(O)C1O')]
+    tree = sygma.Tree(Chem.MolFromSmiles('COc1ccccc1'))
+    tree.metabolize_all_nodes(rules, 2)
+    tree.calc_scores()
+    small_fragments = set(Chem.MolToSmiles(tree.nodes[key].mol) for key in tree.small_fragments())
+    assert small_fragments == set(['CO', 'COC1OC(C(=O)O)C(O)C(O)C1O'])
+    assert len(tree.to_list()) == len(tree.nodes) - 2
+
+def test_treenode_reactants():
+    """Test that reactants are built when a node is metabolized, with implicit hydrogens, and released afterwards"""
+
+    rules = [sygma.Rule('O-demethylation', '0.3', '[#6:1][O:2][CH3:3]>>[#6:1][OH:2]'),
+             sygma.Rule('alcohol_oxidation', '0.2', '[CH2:1][OH:2]>>[CH:1]=[O:2]')]
+    tree = sygma.Tree(Chem.MolFromSmiles('COCCc1ccccc1'))
+    tree.metabolize_all_nodes(rules, 1)
+    node = tree.nodes[sygma.treenode.mol_to_ikey(Chem.MolFromSmiles('OCCc1ccccc1'))]
+    assert node._reactants is None
+    assert len(node.reactants) == 1
+
+    # the hydroxyl made explicit by the first rule can be oxidized in the next cycle
+    tree.metabolize_all_nodes(rules, 1)
+    assert node._reactants is None
+    assert sygma.treenode.mol_to_ikey(Chem.MolFromSmiles('O=CCc1ccccc1')) in tree.nodes
+
+def test_tree_react_unique_products():
+    """Test that identical products of a rule application are returned once and that max_products is passed on"""
+
+    tree = sygma.Tree(Chem.MolFromSmiles('c1ccccc1'))
+    rule = sygma.Rule('aromatic_hydroxylation', '0.2', '[cH:1]>>[c:1]O')
+    products = tree._react(tree.nodes[tree.parentkey].reactants, rule.reaction)
+    assert [smiles for smiles, product in products] == [Chem.MolToSmiles(products[0][1])]
+
+    rule = sygma.Rule('aromatic_hydroxylation', '0.2', '[cH:1]>>[c:1]O', max_products=1)
+    tree = sygma.Tree(Chem.MolFromSmiles('Cc1ccccc1'))
+    tree.metabolize_all_nodes([rule], 1)
+    assert len(tree.nodes) == 2
+
+def test_tree_react_templates():
+    """Test that the fragments of a node are assigned to the reactant templates of a rule in any order"""
+
+    rule = sygma.Rule('condensation', '0.1', '[C:1](=[O:2])[OH:3].[NH2:4][CH2:5]>>[C:1](=[O:2])[NH:4][CH2:5].[OH2:3]')
+    amide = Chem.MolToSmiles(Chem.MolFromSmiles('O=C(NCc1ccccc1)c1ccccc1O'))
+    for smiles in ['OC(=O)c1ccccc1O.NCc1ccccc1', 'NCc1ccccc1.OC(=O)c1ccccc1O']:
+        tree = sygma.Tree(Chem.MolFromSmiles(smiles))
+        products = tree._react(tree.nodes[tree.parentkey].reactants, rule.reaction)
+        assert amide in [smiles for smiles, product in products]
+
+    # a single fragment matching both templates is not combined with itself
+    tree = sygma.Tree(Chem.MolFromSmiles('NCCC(=O)O'))
+    assert tree._react(tree.nodes[tree.parentkey].reactants, rule.reaction) == []
+
+def test_tree_write_read():
+    """Test that a tree read back from write_tree is metabolized further like the tree it was written from"""
+
+    rules = [sygma.Rule('aromatic_hydroxylation', '0.2', '[cH:1]>>[c:1]O',
+                        names=['aromatic_hydroxylation', 'aromatic_hydroxylation_(2)']),
+             sygma.Rule('O-methylation', '0.1', '[c:1][OH:2]>>[c:1][O:2]C')]
+    tree = sygma.Tree(Chem.MolFromSmiles('Cc1ccccc1'))
+    tree.metabolize_all_nodes(rules, 2)
+    tree.calc_scores()
+
+    partial = sygma.Tree(Chem.MolFromSmiles('Cc1ccccc1'))
+    partial.metabolize_all_nodes(rules, 1)
+    partial.metadata['cycles'] = 1
+    f = StringIO()
+    partial.write_tree(f)
+    f.seek(0)
+    resumed = sygma.read_tree(f, rules=rules)
+    assert resumed.metadata == {'cycles': 1}
+    assert resumed.rules == partial.rules
+    resumed.metabolize_all_nodes(rules, 1)
+    resumed.calc_scores()
+    rows = lambda t: [(Chem.MolToSmiles(row['SyGMa_metabolite']), row['SyGMa_score'], row['SyGMa_pathway'])
+                      for row in t.to_list()]
+    assert rows(resumed) == rows(tree)
+
+    # without the rules, the rules of the tree are compiled from the file, with the names of merged rules
+    f.seek(0)
+    assert [rule.names for rule in sygma.read_tree(f).rules] == [rule.names for rule in partial.rules]
+
+    # metabolized further with other rule objects with the same contents, written and read again
+    f.seek(0)
+    resumed = sygma.read_tree(f)
+    resumed.metabolize_all_nodes([sygma.Rule(rule.rulename, rule.probability, rule.smarts, names=rule.names)
+                                  for rule in rules], 1)
+    assert len(resumed.rules) == len(rules)
+    g = StringIO()
+    resumed.write_tree(g)
+    g.seek(0)
+    resumed = sygma.read_tree(g, rules=rules)
+    resumed.calc_scores()
+    assert rows(resumed) == rows(tree)
+
+def test_deduplicate_rules():
+    """Test that rules with the same reaction are merged within and across lists of rules"""
+
+    hydroxylation = sygma.Rule('aromatic_hydroxylation', '0.2', '[cH:1]>>[c:1]O')
+    methylation = sygma.Rule('O-methylation', '0.1', '[c:1][OH:2]>>[c:1][O:2]C')
+    copy = sygma.Rule('hydroxylation', '0.3', '[cH:7]>>[c:7]O')
+    first, second = sygma.deduplicate_rules([[hydroxylation, methylation], [copy, copy]])
+    assert len(first) == 2 and len(second) == 1
+    assert first[0] is second[0]
+    assert first[0].names == ['aromatic_hydroxylation', 'hydroxylation']
+    assert first[0].probability == '0.3'
+    assert hydroxylation.probability == '0.2'
+
+    # the merged rule is not applied again to the parent, which was metabolized in the first step
+    tree = sygma.Tree(Chem.MolFromSmiles('Cc1ccccc1'), profile=True)
+    tree.metabolize_all_nodes(first, 1)
+    n_nodes = len(tree.nodes)
+    tree.metabolize_all_nodes(second, 1)
+    assert tree.stats.rules['aromatic_hydroxylation'][0] == n_nodes
+
+def test_scenario_result_cache(cache_tmpdir):
+    """Test that a scenario with a result cache returns the cached tree of a parent predicted before"""
+
+    rulefile = os.path.join(cache_tmpdir, 'rules.txt')
+    with open(rulefile, 'w') as f:
+        f.write('[cH:1]>>[c:1]O\t0.2\taromatic_hydroxylation\n')
+    cache = sygma.ResultCache(os.path.join(cache_tmpdir, 'results'))
+    tree = sygma.Scenario([[rulefile, 2]], cache=cache).run(Chem.MolFromSmiles('c1ccccc1O'))
+    assert len(cache) == 1
+
+    # the same parent and scenario read from another instance of the cache
+    scenario = sygma.Scenario([[rulefile, 2]], cache=os.path.join(cache_tmpdir, 'results'))
+    cached = scenario.run(Chem.MolFromSmiles('Oc1ccccc1'))
+    assert sorted(cached.nodes) == sorted(tree.nodes)
+    assert len(scenario.cache) == 1
+
+    # a different number of cycles is a different result
+    sygma.Scenario([[rulefile, 1]], cache=cache).run(Chem.MolFromSmiles('c1ccccc1O'))
+    assert len(cache) == 2
+
+    # the least recently used result is removed when the cache is full
+    cache.max_size = 100
+    cache.put('key', 'value')
+    assert len(cache) == 1
+    assert cache.get('key') == 'value'
+
+def test_scenario_result_cache_profile(cache_tmpdir):
+    """Test that a profiled scenario predicts its trees, and that cached trees do not keep the statistics"""
+
+    rulefile = os.path.join(cache_tmpdir, 'rules.txt')
+    with open(rulefile, 'w') as f:
+        f.write('[cH:1]>>[c:1]O\t0.2\taromatic_hydroxylation\n')
+    cache = sygma.ResultCache(os.path.join(cache_tmpdir, 'results'))
+    for _ in range(2):
+        tree = sygma.Scenario([[rulefile, 1]], cache=cache, profile=True).run(Chem.MolFromSmiles('c1ccccc1O'))
+        assert tree.stats.rules['aromatic_hydroxylation'][0] == 1
+    assert len(cache) == 1
+    assert sygma.Scenario([[rulefile, 1]], cache=cache).run(Chem.MolFromSmiles('c1ccccc1O')).stats is None
+
+def test_tree_memo():
+    """Test that trees sharing a memo reuse its products without changing their metabolites"""
+
+    rules = [sygma.Rule('aromatic_hydroxylation', '0.2', '[cH:1]>>[c:1]O'),
+             sygma.Rule('O-glucuronidation', '0.5', '[c:1][OH:2]>>[c:1][O:2]C1OC(C(=O)O)C(O)C(O)C1O')]
+    reference = sygma.Tree(Chem.MolFromSmiles('Cc1ccccc1O'))
+    reference.metabolize_all_nodes(rules, 2)
+    reference.calc_scores()
+
+    memo = sygma.TransformationMemo()
+    for smiles in ['Cc1ccccc1O', 'Oc1ccccc1C']:
+        tree = sygma.Tree(Chem.MolFromSmiles(smiles), memo=memo)
+        tree.metabolize_all_nodes(rules, 2)
+        tree.calc_scores()
+        assert [(Chem.MolToSmiles(row['SyGMa_metabolite']), row['SyGMa_score'], row['SyGMa_pathway'])
+                for row in tree.to_list()] == \
+            [(Chem.MolToSmiles(row['SyGMa_metabolite']), row['SyGMa_score'], row['SyGMa_pathway'])
+             for row in reference.to_list()]
+    assert memo.hits == memo.misses == len(memo)
+
+def test_tree_memo_coordinates():
+    """Test that the products found in a memo get the coordinates of the atoms they are made from"""
+
+    rules = [sygma.Rule('aromatic_hydroxylation', '0.2', '[cH:1]>>[c:1]O'),
+             sygma.Rule('O-glucuronidation', '0.5', '[c:1][OH:2]>>[c:1][O:2]C1OC(C(=O)O)C(O)C(O)C1O')]
+    parentmol = Chem.MolFromSmiles('Cc1ccccc1O')
+    AllChem.Compute2DCoords(parentmol)
+    reference = sygma.Tree(parentmol)
+    reference.metabolize_all_nodes(rules, 2)
+    reference.calc_scores()
+    expected = StringIO()
+    reference.write_sdf(expected)
+
+    memo = sygma.TransformationMemo()
+    for _ in range(2):
+        tree = sygma.Tree(parentmol, memo=memo)
+        tree.metabolize_all_nodes(rules, 2)
+        tree.calc_scores()
+        sdf = StringIO()
+        tree.write_sdf(sdf)
+        assert sdf.getvalue() == expected.getvalue()
+    assert memo.hits == memo.misses == len(memo)
+
+    # the parent with another atom order, of which the products in the memo were made with the first atom order
+    parentmol = Chem.RenumberAtoms(parentmol, list(reversed(range(parentmol.GetNumAtoms()))))
+    tree = sygma.Tree(parentmol, memo=memo)
+    tree.metabolize_all_nodes(rules, 2)
+    assert memo.hits == 2 * memo.misses
+
+    def original_positions(mol):
+        conformer = mol.GetConformer()
+        return sorted(tuple(round(c, 4) for c in conformer.GetAtomPosition(atom.GetIdx()))
+                      for atom in mol.GetAtoms() if atom.GetBoolProp(sygma.treenode.ORIGINAL))
+    for ikey, node in tree.nodes.items():
+        assert original_positions(node.mol) == original_positions(reference.nodes[ikey].mol)
+
+def test_tree_stats():
+    """Test the statistics of a profiled tree"""
+
+    rules = [sygma.Rule('aromatic_hydroxylation', '0.2', '[cH:1]>>[c:1]O'),
+             sygma.Rule('N-demethylation', '0.3', '[N:1][CH3:2]>>[N:1]')]
+    assert sygma.Tree(Chem.MolFromSmiles('c1ccccc1O')).stats is None
+    tree = sygma.Tree(Chem.MolFromSmiles('c1ccccc1O'), profile=True)
+    tree.metabolize_all_nodes(rules, 1)
+    tree.calc_scores()
+    assert tree.stats.rules['aromatic_hydroxylation'][:3] == [1, 5, 3]
+    assert 'N-demethylation' not in tree.stats.rules  # screened out
+    assert tree.stats.stages['scores'][0] == 1
+
+def test_tree_budgets():
+    """Test that budgets stop metabolization and mark the tree as truncated"""
+
+    rules = [sygma.Rule('aromatic_hydroxylation', '0.2', '[cH:1]>>[c:1]O')]
+    tree = sygma.Tree(Chem.MolFromSmiles('c1ccccc1O'))
+    tree.metabolize_all_nodes(rules, 3)
+    assert not tree.truncated
+    n_nodes = len(tree.nodes)
+
+    tree = sygma.Tree(Chem.MolFromSmiles('c1ccccc1O'))
+    tree.metabolize_all_nodes(rules, 3, max_nodes=5)
+    assert tree.truncated
+    assert len(tree.nodes) == 5
+    tree.calc_scores()
+    assert len(tree.to_list()) == 5
+
+    tree = sygma.Tree(Chem.MolFromSmiles('c1ccccc1O'))
+    tree.metabolize_all_nodes(rules, 3, max_atoms=8)
+    assert tree.truncated
+    assert all(node.mol.GetNumHeavyAtoms() <= 8 for node in tree.nodes.values())
+
+    tree = sygma.Tree(Chem.MolFromSmiles('c1ccccc1O'))
+    tree.metabolize_all_nodes(rules, 3, max_products=1)
+    assert tree.truncated
+    assert len(tree.nodes) < n_nodes
+
+    # a budget of exactly the five outcomes of hydroxylating phenol does not truncate the tree
+    tree = sygma.Tree(Chem.MolFromSmiles('c1ccccc1O'))
+    tree.metabolize_all_nodes(rules, 1, max_products=5)
+    assert not tree.truncated
+    tree = sygma.Tree(Chem.MolFromSmiles('c1ccccc1O'))
+    tree.metabolize_all_nodes(rules, 1, max_products=4)
+    assert tree.truncated
+
+def test_scenario_budgets(cache_tmpdir, caplog):
+    """Test that the steps of a scenario stop once the node budget ran out, with one warning"""
+
+    rulefile = os.path.join(cache_tmpdir, 'rules.txt')
+    with open(rulefile, 'w') as f:
+        f.write('[cH:1]>>[c:1]O\t0.2\taromatic_hydroxylation\n')
+    scenario = sygma.Scenario([[rulefile, 2], [rulefile, 1]], deduplicate=False)
+    with caplog.at_level('WARNING', logger='sygma'):
+        tree = scenario.run(Chem.MolFromSmiles('c1ccccc1O'), max_nodes=2)
+    assert tree.truncated
+    assert len(tree.nodes) == 2
+    assert caplog.text.count('Stopped metabolizing') == 1
+
+def test_server(cache_tmpdir):
+    """Test single and batch requests to the SyGMa server"""
+    import json
+    import threading
+    from urllib.error import HTTPError
+    from urllib.request import urlopen
+    import sygma.server
+
+    rulefile = os.path.join(cache_tmpdir, 'rules.txt')
+    with open(rulefile, 'w') as f:
+        f.write('[cH:1]>>[c:1]O\t0.2\taromatic_hydroxylation\n')
+    scenarios = sygma.server.read_scenarios({'default': [[rulefile, 1]]})
+    server = sygma.server.SygmaServer(('127.0.0.1', 0), scenarios, jobs=2)
+    threading.Thread(target=server.serve_forever).start()
+    url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    try:
+        assert json.loads(urlopen(url + 'scenarios').read().decode('utf-8')) == {'default': [[rulefile, 1]]}
+
+        def post(data):
+            return json.loads(urlopen(url + 'predict', json.dumps(data).encode('utf-8')).read().decode('utf-8'))
+
+        result = post({'smiles': 'c1ccccc1O', 'id': 'phenol'})
+        assert result['id'] == 'phenol'
+        assert len(result['metabolites']) == 4
+        assert result['metabolites'][0] == {'smiles': 'Oc1ccccc1', 'score': 1, 'pathway': 'parent;'}
+
+        results = post({'requests': [{'smiles': 'c1ccccc1O', 'cycles': [2], 'output': 'smiles'},
+                                     {'smiles': 'x'}]})
+        assert len(results[0]['metabolites'].splitlines()) > 4
+        assert 'error' in results[1]
+
+        # a request that finds its worker processes dead fails, the next one is predicted by new workers
+        executor = server.executor
+        for process in list(executor._processes.values()):
+            process.kill()
+            process.join()
+        with pytest.raises(HTTPError) as error:
+            post({'smiles': 'c1ccccc1O'})
+        assert error.value.code == 500
+        assert 'error' in json.loads(error.value.read().decode('utf-8'))
+        assert server.executor is not executor
+        assert len(post({'smiles': 'c1ccccc1O'})['metabolites']) == 4
+    finally:
+        server.shutdown()
+        server.server_close()
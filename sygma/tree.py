@@ -1,70 +1,510 @@
 from rdkit import Chem
-from rdkit.Chem import AllChem
-import copy
+import hashlib
+import heapq
 import itertools
+import json
+import multiprocessing
 import sys
-from sygma.treenode import TreeNode
+import time
+from sygma.stats import TreeStats
+from sygma.treenode import ATOM_INDEX, ORIGINAL, PICKLE_PROPS, TreeNode, identity_keys, mol_to_ikey
 import logging
 logger = logging.getLogger('sygma')
 
 
+def ruleset_key(rules):
+    """Return a string identifying a list of rules by their names, probabilities and smarts"""
+    sha = hashlib.sha1()
+    for rule in rules:
+        sha.update(u'{}\t{}\t{}\n'.format(rule.smarts, rule.probability, rule.rulename).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def rule_key(rule):
+    """Return a key identifying a rule by the products it makes: its canonical smarts, probability and max_products"""
+    return rule.canonical, rule.probability, rule.max_products
+
+
+# Atom properties set by RDKit on products of reactions, not needed once the ORIGINAL atom property is set
+REACTION_ATOM_PROPS = ('old_mapno', 'react_atom_idx', 'react_idx', '_ReactionDegreeChanged', 'molInversionFlag')
+
+# Version of the JSON lines format written by Tree.write_tree
+TREE_FORMAT_VERSION = 1
+
+# Product fragments with at most this number of atoms, such as water or leftovers of cofactors, are sanitized once
+SMALL_FRAGMENT_ATOMS = 6
+
+
+def original_flags(mol):
+    """
+    Return the ORIGINAL property of the atoms of mol, in the order in which they were written in
+    the last smiles of mol
+    """
+    order = mol.GetPropsAsDict(True, True)['_smilesAtomOutputOrder']
+    return tuple(mol.GetAtomWithIdx(idx).GetBoolProp(ORIGINAL) for idx in order)
+
+
+def outcome_key(mol, ranks=None):
+    """
+    Return a key to choose one of the identical products made from different atoms of a symmetric substrate:
+    the ORIGINAL property of the atoms of mol and the rank in ranks of the substrate atom (ATOM_INDEX property)
+    of each atom, in the order in which they were written in the last smiles of mol
+    """
+    atoms = [mol.GetAtomWithIdx(idx) for idx in mol.GetPropsAsDict(True, True)['_smilesAtomOutputOrder']]
+    return (tuple(atom.GetBoolProp(ORIGINAL) for atom in atoms),
+            () if ranks is None else
+            tuple(ranks.get(atom.GetIntProp(ATOM_INDEX), -1) if atom.HasProp(ATOM_INDEX) else -1 for atom in atoms))
+
+
+def substrate_key(mol):
+    """Return a key identifying a molecule with the atoms that originate from the parent molecule"""
+    return Chem.MolToSmiles(mol), original_flags(mol)
+
+
+_worker_tree = None
+_worker_rules = None
+_worker_budgets = None
+
+
+def _init_worker(rules, identity, memo=None, profile=False, max_products=None, max_atoms=None):
+    """Prepare a worker process of Tree.metabolize_all_nodes"""
+    global _worker_tree, _worker_rules, _worker_budgets
+    _worker_tree = Tree(identity=identity, memo=memo, profile=profile)
+    _worker_rules = rules
+    _worker_budgets = {'max_products': max_products, 'max_atoms': max_atoms}
+
+
+def _metabolize_blob(task):
+    """
+    Metabolize the molecule in an RDKit binary blob in a worker process, task is a tuple (blob, indices of
+    the rules to skip)
+
+    :return:
+        List of (rule index, [(ikey, product as RDKit binary blob)]), the TreeStats of metabolizing the molecule
+        or None if the tree is not profiled, and whether a budget truncated the products
+    """
+    blob, skip = task
+    mol = Chem.Mol(blob)
+    node = TreeNode(mol, ikey="")
+    if _worker_tree.stats is not None:
+        _worker_tree.stats = TreeStats()
+    _worker_tree.truncated = False
+    metabolites = [(idx, [(ikey, x.ToBinary(PICKLE_PROPS)) for ikey, x in products])
+                   for idx, products in _worker_tree._metabolites(node.reactants, _worker_rules, substrate=mol,
+                                                                  skip=skip, **_worker_budgets)]
+    return metabolites, _worker_tree.stats, _worker_tree.truncated
+
+
 class Tree(object):
     """
     Class to build and analyse a metabolic tree
 
     :param parentmol:
         An RDKit molecule
+    :param identity:
+        Name of the strategy to compute the keys on which metabolites are deduplicated:
+        "inchikey" (first 14 characters of the InChIKey, the default), "smiles" (canonical isomeric smiles)
+        or "molhash" (RDKit tautomer insensitive MolHash)
+    :param memo:
+        A :class:`sygma.memo.TransformationMemo` with the products of rules applied to substrates, which can be
+        shared by trees. The products found in the memo get the coordinates of their atoms from the node they are
+        made from, as products of reactions do, so the memo does not change the tree.
+    :param profile:
+        Boolean to count and time the stages of building and analysing the tree, and the application of
+        each rule, in self.stats (a :class:`sygma.stats.TreeStats`). self.stats is None if False.
+
+    self.truncated is True when a budget of metabolize_all_nodes ran out, and the tree holds only part of
+    the metabolites. It can still be scored and written.
+
+    self.metadata is a dictionary of JSON serializable values describing how the tree was made, e.g. the steps of
+    the Scenario that predicted it, which is written with the tree by write_tree.
     """
-    def __init__(self, parentmol=None):
+    def __init__(self, parentmol=None, identity="inchikey", memo=None, profile=False):
+        if identity not in identity_keys:
+            raise ValueError("Unknown identity strategy: " + str(identity))
+        self.identity = identity
+        self.memo = memo
+        self.stats = TreeStats() if profile else None
+        self.truncated = False
+        self.metadata = {}
         self.nodes = {}
+        self.keys = []  # [ikey], the index of a node in this list is its TreeNode.index, None if removed
+        self.rules = []  # the rules that transformed nodes, referenced by their index in TreeNode.parents
+        self._rule_indices = {}  # {(rulename, probability, smarts): index in self.rules}
+        self.expanded = {}  # {ruleset_key: set of ikeys of nodes metabolized with that ruleset}
+        self.ruleset_rules = {}  # {ruleset_key: set of rule_key of the rules in that ruleset}
+        self.ikeys = {}  # {canonical isomeric smiles: ikey}, to compute the ikey of each product only once
+        self._small_fragments = None
+        self._sanitized = {}  # {fragment key: sanitized copy or None if sanitization failed}, for small fragments
         if parentmol:
-            parentnode = TreeNode(parentmol, parent=None, rule=None, score=1, pathway="")
+            parentnode = TreeNode(parentmol, parent=None, rule=None, score=1, pathway="",
+                                  ikey=self._ikey(parentmol), index=0)
             self.nodes[parentnode.ikey] = parentnode
+            self.keys.append(parentnode.ikey)
             self.parentkey = parentnode.ikey
 
-    def _react(self, reactants, reaction):
-        """Apply reaction to reactant and return products"""
-        products = []
-        # addition inspired by connor to make reactant templates work
-        combinations = itertools.combinations(reactants, reaction.GetNumReactantTemplates())
-        for combination in combinations:
-            ps = reaction.RunReactants(combination)
-            
+    def __getstate__(self):
+        # the memos are not pickled, they are rebuilt when the tree is metabolized further
+        state = self.__dict__.copy()
+        state.update(ikeys={}, _sanitized={}, _small_fragments=None, memo=None)
+        return state
+
+    def _react(self, reactants, reaction, max_products=None, rulename=None, budget=False, ranks=None,
+               atom_indices=False):
+        """
+        Apply reaction to reactant and return the products as (smiles, product) tuples, where smiles is the
+        canonical smiles of the product before sanitization. Products with the same smiles are returned once.
+
+        :param max_products:
+            Integer, maximum number of outcomes of RDKit's RunReactants for each combination of reactants,
+            RDKit's default if None
+        :param rulename:
+            Name of the rule of the reaction, under which the number of matches is counted in self.stats
+        :param budget:
+            Boolean, max_products is a budget: the tree is marked as truncated if RunReactants has more outcomes
+        :param ranks:
+            Dictionary {atom index: rank} of the atoms of the molecule of which reactants are the fragments,
+            in the order of its canonical smiles. Of identical products made from different atoms, the one with the
+            highest outcome_key is kept, which is the same product whatever the atom order of the reactants.
+        :param atom_indices:
+            Boolean to keep the ATOM_INDEX atom property of the reactant atoms on the product atoms made from them
+        """
+        stats = self.stats
+        fragments = {}  # {smiles: fragment}, each product of this rule application is sanitized only once
+        keys = {}  # {smiles: outcome_key(fragment)} of products that were found more than once
+        for combination in self._combinations(reactants, reaction):
+            if stats is not None:
+                start = time.perf_counter()
+            if max_products is None:
+                ps = reaction.RunReactants(combination)
+            elif budget:
+                # one more outcome than the budget, to tell whether the budget cut the outcomes short
+                ps = reaction.RunReactants(combination, max_products + 1)
+                if len(ps) > max_products:
+                    ps = ps[:max_products]
+                    self.truncated = True
+            else:
+                ps = reaction.RunReactants(combination, max_products)
+            if stats is not None:
+                stats.add_stage('react', time.perf_counter() - start)
+                stats.add_rule(rulename, matches=len(ps))
+                start = time.perf_counter()
+
             for outcome in ps:
                 for product in outcome:
                     # print('~~prod: {}'.format(Chem.MolToSmiles(product)))
+                    # mark the product atoms that are mapped onto original atoms of the reactants
+                    for atom in product.GetAtoms():
+                        if atom.HasProp('react_atom_idx'):
+                            source = combination[atom.GetIntProp('react_idx')].GetAtomWithIdx(
+                                atom.GetIntProp('react_atom_idx'))
+                            atom.SetBoolProp(ORIGINAL, source.GetBoolProp(ORIGINAL))
+                            if source.HasProp(ATOM_INDEX):
+                                atom.SetIntProp(ATOM_INDEX, source.GetIntProp(ATOM_INDEX))
+                        else:
+                            atom.SetBoolProp(ORIGINAL, False)
+                        for prop in REACTION_ATOM_PROPS:
+                            atom.ClearProp(prop)
                     frags = (Chem.GetMolFrags(product, asMols=True, sanitizeFrags=False))
                     for p in frags:
-                        q = copy.copy(p)
-                        try:
-                            Chem.SanitizeMol(q)
-                            q.UpdatePropertyCache()
-                            products.append(q)
-                        except Exception as e:
-                            pass # Ignore fragments that cannot be sanitized
+                        p.UpdatePropertyCache(strict=False)
+                        smiles = Chem.MolToSmiles(p)
+                        if smiles not in fragments:
+                            fragments[smiles] = p
+                            continue
+                        # identical to an earlier outcome, e.g. of a symmetric substrate. Keep the same one of both,
+                        # whatever the atom order of the reactants
+                        if smiles not in keys:
+                            keys[smiles] = outcome_key(fragments[smiles], ranks)
+                        p_key = outcome_key(p, ranks)
+                        if p_key > keys[smiles]:
+                            fragments[smiles] = p
+                            keys[smiles] = p_key
+            if stats is not None:
+                stats.add_stage('fragments', time.perf_counter() - start)
+        if stats is not None:
+            start = time.perf_counter()
+        products = []
+        # the products in order of their smiles, so they do not depend on the atom order of the reactants
+        for smiles in sorted(fragments):
+            p = fragments[smiles]
+            key = None
+            if p.GetNumAtoms() <= SMALL_FRAGMENT_ATOMS:
+                key = (smiles, keys[smiles][0] if smiles in keys else original_flags(p))
+                # in the order of the smiles, the atom order of the sanitized copy
+                p = Chem.RenumberAtoms(p, p.GetPropsAsDict(True, True)['_smilesAtomOutputOrder'])
+            if not atom_indices:
+                for atom in p.GetAtoms():
+                    atom.ClearProp(ATOM_INDEX)
+            if key in self._sanitized:
+                if self._sanitized[key] is not None:
+                    products.append((smiles, self._copy_sanitized(self._sanitized[key], p)))
+                continue
+            try:
+                Chem.SanitizeMol(p)
+            except Exception as e:
+                p = None # Ignore fragments that cannot be sanitized
+            if key is not None:
+                self._sanitized[key] = p if p is None else Chem.Mol(p)
+            if p is not None:
+                products.append((smiles, p))
+        if stats is not None:
+            stats.add_stage('sanitize', time.perf_counter() - start, len(fragments))
         return products
 
-    def metabolize_node(self, node, rules):
-        for rule in rules:
-            products = self._react(node.reactants, rule.reaction)
-            ident = 0
-            for x in products:
-                try:
-                    ikey = AllChem.InchiToInchiKey(AllChem.MolToInchi(x))[:14]
-                except Exception as e:
-                    ikey = Chem.MolToSmiles(x, 1)
-                x.SetProp("_Name", ikey)
-                node.children.append(ikey)
-                if ikey in self.nodes: # if the predicted product (x) is already in self.nodes
-                    # and if the parent is not yet in the parents list of the predicted product
-                    if node.ikey not in self.nodes[ikey].parents or \
-                                    self.nodes[ikey].parents[node.ikey].probability < rule.probability:
-                        self.nodes[ikey].parents[node.ikey] = rule
+    @staticmethod
+    def _copy_sanitized(sanitized, fragment):
+        """
+        Return a copy of a sanitized small fragment with the coordinates and the ATOM_INDEX atom properties of
+        an unsanitized fragment with the same smiles and atom order
+        """
+        mol = Chem.Mol(sanitized)
+        mol.RemoveAllConformers()
+        for atom, fragment_atom in zip(mol.GetAtoms(), fragment.GetAtoms()):
+            if fragment_atom.HasProp(ATOM_INDEX):
+                atom.SetIntProp(ATOM_INDEX, fragment_atom.GetIntProp(ATOM_INDEX))
+            else:
+                atom.ClearProp(ATOM_INDEX)
+        for conformer in fragment.GetConformers():
+            mol.AddConformer(Chem.Conformer(conformer), assignId=True)
+        return mol
+
+    @staticmethod
+    def _combinations(reactants, reaction):
+        """
+        Generate the tuples of reactants to apply reaction to: each reactant for a reaction with one reactant template,
+        otherwise each ordered assignment of distinct reactants that match the reactant templates
+        """
+        n_templates = reaction.GetNumReactantTemplates()
+        if n_templates == 1:
+            for reactant in reactants:
+                yield (reactant,)
+            return
+        # the reactants that match each template, every reactant is matched to every template only once
+        matches = [[idx for idx, reactant in enumerate(reactants) if reactant.HasSubstructMatch(template)]
+                   for template in reaction.GetReactants()]
+        for assignment in itertools.product(*matches):
+            if len(set(assignment)) == n_templates:
+                yield tuple(reactants[idx] for idx in assignment)
+
+    def _ikey(self, mol, smiles=None):
+        """
+        Return the ikey of a molecule, looked up by its canonical smiles if the molecule was seen before
+
+        :param smiles:
+            Canonical smiles of the molecule, e.g. from before sanitization, computed if None
+        """
+        if self.identity == "smiles":
+            return Chem.MolToSmiles(mol, 1)
+        if smiles is None:
+            smiles = Chem.MolToSmiles(mol, 1)
+        ikey = self.ikeys.get(smiles)
+        if ikey is None:
+            if self.stats is not None:
+                start = time.perf_counter()
+            ikey = identity_keys[self.identity](mol)
+            if self.stats is not None:
+                self.stats.add_stage('ikey', time.perf_counter() - start)
+            self.ikeys[smiles] = ikey
+        return ikey
+
+    def _metabolites(self, reactants, rules, substrate=None, max_products=None, max_atoms=None, skip=()):
+        """
+        Generate the products of applying each of the rules to the reactants of a node
+
+        :param substrate:
+            The molecule of the node. The order of its atoms in its canonical smiles decides which of the identical
+            products made from symmetric atoms is kept (see _react). With a memo, the products of each rule are
+            looked up under its substrate_key, and get the coordinates of its atoms they are made from.
+        :param max_products:
+            Integer, budget of products of RunReactants for each combination of reactants, see metabolize_all_nodes
+        :param max_atoms:
+            Integer, products with more heavy atoms are left out, see metabolize_all_nodes
+        :param skip:
+            Set of indices of rules that are not applied
+        :return:
+            Tuples (rule index, list of (ikey, product)) for each rule with products
+        """
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
+        fingerprints = [Chem.PatternFingerprint(reactant) for reactant in reactants]
+        matching = [idx for idx, rule in enumerate(rules) if idx not in skip and rule.can_match(fingerprints)]
+        if stats is not None:
+            stats.add_stage('screen', time.perf_counter() - start)
+        ranks = None
+        if substrate is not None:
+            substrate_smiles = substrate_key(substrate)
+            # the atoms of substrate in the order of its canonical smiles, which is the same for each molecule
+            # with this key, to map the atoms of products in the memo onto the atoms of substrate
+            order = substrate.GetPropsAsDict(True, True)['_smilesAtomOutputOrder']
+            ranks = dict((atom_idx, rank) for rank, atom_idx in enumerate(order))
+        # only the rules that can match any of the fragments of the node are applied
+        for idx in matching:
+            rule = rules[idx]
+            if stats is not None:
+                start = time.perf_counter()
+            rule_max_products = rule.max_products
+            budget = max_products is not None and (rule_max_products is None or max_products < rule_max_products)
+            if budget:
+                rule_max_products = max_products
+            truncated, self.truncated = self.truncated, False
+            if self.memo is None or substrate is None:
+                products = self._react(reactants, rule.reaction, max_products=rule_max_products,
+                                       rulename=rule.rulename, budget=budget, ranks=ranks)
+                if max_atoms is not None:
+                    products = self._limit_atoms(products, max_atoms)
+                products = [(self._ikey(x, smiles), x) for smiles, x in products]
+            else:
+                key = (substrate_smiles, rule.smarts, rule_max_products, self.identity)
+                blobs = self.memo.get(key)
+                if blobs is None:
+                    blobs = []
+                    products = []
+                    for smiles, x in self._react(reactants, rule.reaction, max_products=rule_max_products,
+                                                 rulename=rule.rulename, budget=budget, ranks=ranks,
+                                                 atom_indices=True):
+                        ikey = self._ikey(x, smiles)
+                        # the rank of the substrate atom each product atom is made from, -1 for new atoms
+                        sources = []
+                        for atom in x.GetAtoms():
+                            sources.append(ranks[atom.GetIntProp(ATOM_INDEX)] if atom.HasProp(ATOM_INDEX) else -1)
+                            atom.ClearProp(ATOM_INDEX)
+                        products.append((ikey, x))
+                        # the coordinates depend on the tree in which the product was made, they are left out
+                        stored = Chem.Mol(x)
+                        stored.RemoveAllConformers()
+                        blobs.append((ikey, stored.ToBinary(PICKLE_PROPS), tuple(sources)))
+                    if not self.truncated:
+                        self.memo.put(key, blobs)  # products cut short by a budget are not kept
                 else:
-                    self.nodes[ikey] = TreeNode(x, parent=node.ikey, rule=rule, uniqueIdent=ident)
-                    ident +=1
+                    products = [(ikey, self._place(Chem.Mol(blob), sources, substrate, order))
+                                for ikey, blob, sources in blobs]
+                    if stats is not None:
+                        stats.add_stage('memo', time.perf_counter() - start)
+                if max_atoms is not None:
+                    products = self._limit_atoms(products, max_atoms)
+            self.truncated = self.truncated or truncated
+            if stats is not None:
+                stats.add_rule(rule.rulename, calls=1, products=len(products), seconds=time.perf_counter() - start)
+            if len(products) > 0:
+                yield idx, products
+
+    @staticmethod
+    def _place(product, sources, substrate, order):
+        """
+        Give a product found in the memo the coordinates of the substrate atoms it is made from, as RDKit's
+        RunReactants does, where sources holds the rank in order of the substrate atom of each product atom
+        """
+        if substrate.GetNumConformers() > 0:
+            substrate_conformer = substrate.GetConformer()
+            conformer = Chem.Conformer(product.GetNumAtoms())
+            conformer.Set3D(substrate_conformer.Is3D())
+            for idx, rank in enumerate(sources):
+                if rank >= 0:
+                    conformer.SetAtomPosition(idx, substrate_conformer.GetAtomPosition(order[rank]))
+            product.AddConformer(conformer)
+        return product
+
+    def _limit_atoms(self, products, max_atoms):
+        """Return the (key, product) tuples with at most max_atoms heavy atoms, marking the tree as truncated if any"""
+        kept = [(key, x) for key, x in products if x.GetNumHeavyAtoms() <= max_atoms]
+        if len(kept) < len(products):
+            self.truncated = True
+        return kept
+
+    def _rule_index(self, rule):
+        """
+        Return the index in self.rules of rule, or of the rule with the same name, probability and smarts,
+        adding it if needed
+        """
+        key = (rule.rulename, rule.probability, rule.smarts)
+        if key not in self._rule_indices:
+            self._rule_indices[key] = len(self.rules)
+            self.rules.append(rule)
+        return self._rule_indices[key]
 
-    def metabolize_all_nodes(self, rules, cycles=1):
+    def node_parents(self, node):
+        """Return the parents of node as a dictionary {ikey_of_parent: rule_transforming_parent_to_node}"""
+        return dict((None if pidx is None else self.keys[pidx], None if ridx is None else self.rules[ridx])
+                    for pidx, ridx in node.parents.items())
+
+    def _add_metabolites(self, node, rule, products, min_score=None, max_nodes=None):
+        """
+        Add the products [(ikey, product)] of applying rule to node to the tree,
+        except new products with a score below min_score, or when the tree has max_nodes nodes
+        """
+        self._small_fragments = None
+        ridx = self._rule_index(rule)
+        ident = 0
+        score = None if node.score is None else node.score * float(rule.probability)
+        for ikey, x in products:
+            if ikey in self.nodes: # if the predicted product (x) is already in self.nodes
+                child = self.nodes[ikey]
+                node.children.add(child.index)
+                # and if the parent is not yet in the parents list of the predicted product
+                if node.index not in child.parents or \
+                                self.rules[child.parents[node.index]].probability < rule.probability:
+                    child.parents[node.index] = ridx
+                self._raise_score(child, score)
+            elif max_nodes is not None and len(self.nodes) >= max_nodes:
+                self.truncated = True
+            elif min_score is None or score is None or score >= min_score:
+                x.SetProp("_Name", ikey)
+                index = len(self.keys)
+                node.children.add(index)
+                self.nodes[ikey] = TreeNode(x, parent=node.index, rule=ridx, score=score, uniqueIdent=ident, ikey=ikey,
+                                            index=index)
+                self.keys.append(ikey)
+                ident +=1
+
+    def _raise_score(self, node, score):
+        """Raise the score of node to score, if higher, and propagate the increase to its descendants"""
+        stack = [(node, score)]
+        while len(stack) > 0:
+            node, score = stack.pop()
+            if score is None or node.score is None or score <= node.score:
+                continue
+            node.score = score
+            for cidx in node.children:
+                child = self.nodes[self.keys[cidx]]
+                stack.append((child, score * float(self.rules[child.parents[node.index]].probability)))
+
+    def metabolize_node(self, node, rules, min_score=None, max_nodes=None, max_products=None, max_atoms=None,
+                        skip=()):
+        """
+        Metabolize a node according to [rules]
+
+        :param min_score:
+            New metabolites with a score below min_score are not added to the tree
+        :param max_nodes, max_products, max_atoms:
+            Budgets, see metabolize_all_nodes
+        :param skip:
+            Set of indices of rules that are not applied, e.g. because they were applied to node before
+        """
+        for idx, products in self._metabolites(node.reactants, rules, substrate=node.mol, max_products=max_products,
+                                               max_atoms=max_atoms, skip=skip):
+            if self.stats is not None:
+                start = time.perf_counter()
+            self._add_metabolites(node, rules[idx], products, min_score=min_score, max_nodes=max_nodes)
+            if self.stats is not None:
+                self.stats.add_stage('add', time.perf_counter() - start)
+        del node.reactants
+
+    def _prune(self, keys, max_nodes):
+        """Remove all but the max_nodes highest scoring of the (not yet metabolized) nodes with keys"""
+        self._small_fragments = None
+        ranked = sorted(keys, key=lambda key: self.nodes[key].score or 0.0, reverse=True)
+        for key in ranked[max_nodes:]:
+            node = self.nodes.pop(key)
+            self.keys[node.index] = None
+            for pidx in node.parents:
+                self.nodes[self.keys[pidx]].children.discard(node.index)
+        if len(ranked) > max_nodes:
+            logger.info('Pruned {} of {} new metabolites'.format(len(ranked) - max_nodes, len(ranked)))
+
+    def metabolize_all_nodes(self, rules, cycles=1, processes=None, min_score=None, max_nodes_per_cycle=None,
+                             max_nodes=None, max_time=None, max_products=None, max_atoms=None):
         """
         Metabolize all nodes according to [rules], for [cycles] number of cycles
 
@@ -72,44 +512,236 @@ class Tree(object):
             List of rules
         :param cycles:
             Integer indicating the number of subsequent steps to apply the rules
+        :param processes:
+            Integer, number of worker processes to metabolize the nodes of each cycle in parallel.
+            The products are added to the tree in the same order as in a serial run, which gives an identical tree.
+            The workers look up products in a copy of self.memo, the products they make are not added to it.
+        :param min_score:
+            Metabolites with a score below min_score are not added to the tree, and therefore never metabolized
+        :param max_nodes_per_cycle:
+            Integer, maximum number of new metabolites kept in each cycle, the metabolites with the highest scores
+
+        The following budgets mark the tree as truncated (self.truncated) when they run out:
+
+        :param max_nodes:
+            Integer, maximum number of nodes of the tree. No nodes are added or metabolized once it is reached.
+        :param max_time:
+            Maximum wall time in seconds, checked after each metabolized node. Metabolization stops when it is exceeded.
+        :param max_products:
+            Integer, maximum number of products of RunReactants for each combination of reactants a rule is applied
+            to, or the maximum of the rule (Rule.max_products) if that is lower
+        :param max_atoms:
+            Integer, products with more heavy atoms are not added to the tree
+        :return:
+            True if metabolization stopped because the max_nodes or max_time budget ran out
         """
-        for i in range(cycles):
-            logger.info('Cycle ' + str(i + 1))
-            ikeys = list(self.nodes.keys())
-            for ikey in ikeys:
-                self.metabolize_node(self.nodes[ikey], rules)
+        deadline = None if max_time is None else time.time() + max_time
+
+        def out_of_budget():
+            if (max_nodes is not None and len(self.nodes) >= max_nodes) or \
+                    (deadline is not None and time.time() > deadline):
+                self.truncated = True
+                logger.warning('Stopped metabolizing {} after reaching a budget, with {} nodes'.format(
+                    self.parentkey, len(self.nodes)))
+                return True
+            return False
+
+        key = ruleset_key(rules)
+        expanded = self.expanded.setdefault(key, set())
+        rule_keys = [rule_key(rule) for rule in rules]
+        self.ruleset_rules[key] = set(rule_keys)
+        # rules shared with other rulesets, e.g. by deduplicate_rules, are not applied again to the nodes
+        # metabolized with those rulesets, as they only reproduce known products
+        shared = []
+        for other, other_keys in self.ruleset_rules.items():
+            indices = frozenset(idx for idx, rkey in enumerate(rule_keys) if rkey in other_keys)
+            if other != key and len(indices) > 0:
+                shared.append((self.expanded.get(other, ()), indices))
+
+        def applied(ikey):
+            skip = frozenset()
+            for ikeys, indices in shared:
+                if ikey in ikeys:
+                    skip = skip | indices
+            return skip
+
+        pool = None
+        stopped = False
+        if processes is not None and processes > 1:
+            pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                        initargs=(rules, self.identity, self.memo, self.stats is not None,
+                                                  max_products, max_atoms))
+        try:
+            for i in range(cycles):
+                logger.info('Cycle ' + str(i + 1))
+                # only the nodes not yet metabolized with these rules form the frontier,
+                # applying the rules again to the other nodes only reproduces known products
+                frontier = [ikey for ikey in self.nodes if ikey not in expanded and
+                            (min_score is None or self.nodes[ikey].score is None or self.nodes[ikey].score >= min_score)]
+                if len(frontier) == 0:
+                    break
+                n_nodes = len(self.nodes)
+                if pool is None:
+                    for ikey in frontier:
+                        if out_of_budget():
+                            stopped = True
+                            break
+                        self.metabolize_node(self.nodes[ikey], rules, min_score=min_score, max_nodes=max_nodes,
+                                             max_products=max_products, max_atoms=max_atoms, skip=applied(ikey))
+                        expanded.add(ikey)
+                else:
+                    tasks = [(self.nodes[ikey]._mol, applied(ikey)) for ikey in frontier]
+                    chunksize = max(1, len(tasks) // (4 * processes))
+                    # imap returns the results in the order of the frontier
+                    for ikey, (metabolites, stats, truncated) in zip(frontier, pool.imap(_metabolize_blob, tasks,
+                                                                                         chunksize)):
+                        if out_of_budget():
+                            stopped = True
+                            break
+                        self.truncated = self.truncated or truncated
+                        if stats is not None:
+                            self.stats.update(stats)
+                            start = time.perf_counter()
+                        for idx, products in metabolites:
+                            self._add_metabolites(self.nodes[ikey], rules[idx],
+                                                  [(pkey, Chem.Mol(blob)) for pkey, blob in products],
+                                                  min_score=min_score, max_nodes=max_nodes)
+                        if stats is not None:
+                            self.stats.add_stage('add', time.perf_counter() - start, len(metabolites))
+                        expanded.add(ikey)
+                if max_nodes_per_cycle is not None:
+                    # the nodes are kept in order of addition, so the new nodes are at the end
+                    self._prune(list(self.nodes)[n_nodes:], max_nodes_per_cycle)
+                if stopped:
+                    break
+        finally:
+            if pool is not None:
+                if stopped:
+                    pool.terminate()  # the remaining nodes of the frontier are not needed
+                else:
+                    pool.close()
+                pool.join()
+        return stopped
 
     def add_coordinates(self):
         """
         Add missing atomic coordinates to all metabolites
         """
         for node in self.nodes.values():
-            node.gen_coords()
+            self._gen_coords(node)
+
+    def _gen_coords(self, node):
+        """Generate the missing coordinates of node, timed in self.stats"""
+        if self.stats is None:
+            return node.gen_coords()
+        start = time.perf_counter()
+        node.gen_coords()
+        self.stats.add_stage('coords', time.perf_counter() - start)
 
     def calc_scores(self):
         """
         Calculate probability scores for all metabolites
+
+        The score of a metabolite is the highest product of the rule probabilities along any path from the parent,
+        computed in a single pass over the tree, in order of decreasing score (like Dijkstra's algorithm).
+        The pathway of a metabolite follows the path with this score, taking the first of its parents on a tie.
         """
+        if self.stats is not None:
+            start = time.perf_counter()
+        children = dict((node.index, []) for node in self.nodes.values())
+        for node in self.nodes.values():
+            if node.ikey != self.parentkey:
+                node.score = None
+            for pidx in node.parents:
+                if pidx is not None:
+                    children[pidx].append(node)
+        via = {}  # {index: index of the parent on the best path}
+        finished = set()
+        counter = itertools.count()  # to pop nodes with equal scores in order of insertion
+        parentnode = self.nodes[self.parentkey]
+        heap = [(-parentnode.score, next(counter), parentnode)]
+        while len(heap) > 0:
+            negscore, n, node = heapq.heappop(heap)
+            if node.index in finished:
+                continue
+            finished.add(node.index)
+            for child in children[node.index]:
+                if child.index in finished:
+                    continue
+                rule = self.rules[child.parents[node.index]]
+                newscore = node.score * float(rule.probability)
+                if child.score is None or newscore > child.score or (newscore == child.score and
+                        list(child.parents).index(node.index) < list(child.parents).index(via[child.index])):
+                    child.score = newscore
+                    via[child.index] = node.index
+                    uniqueIdent = ""
+                    if child.uniqueIdent > 0:
+                        uniqueIdent = "_" + str(child.uniqueIdent)
+                    child.pathway = node.pathway + str(rule.rulename).strip() + uniqueIdent + ";"
+                    heapq.heappush(heap, (-newscore, next(counter), child))
+        if self.stats is not None:
+            self.stats.add_stage('scores', time.perf_counter() - start)
+
+    def small_fragments(self):
+        """
+        Return the set of keys of the small fragments, i.e. metabolites with less then 15% of original atoms
+        (of the parent), and all their descendants, to be filtered from the output
+        """
+        if self._small_fragments is None:
+            n_parent_atoms = self.nodes[self.parentkey].mol.GetNumAtoms()
+            stack = [key for key, node in self.nodes.items() if node.n_original_atoms <= 0.15 * n_parent_atoms]
+            small_fragments = set(stack)
+            while len(stack) > 0:
+                for cidx in self.nodes[stack.pop()].children:
+                    ckey = self.keys[cidx]
+                    if ckey not in small_fragments:
+                        small_fragments.add(ckey)
+                        stack.append(ckey)
+            small_fragments.discard(self.parentkey)
+            self._small_fragments = small_fragments  # cached until nodes are added or removed
+        return self._small_fragments
+
+    def _output_keys(self, filter_small_fragments=True, min_score=None, top_n=None):
+        """Return the keys of the metabolites to output, sorted by decreasing score"""
+        keys = []
+        small_fragments = self.small_fragments() if filter_small_fragments else set()
         for key in self.nodes:
-            self.calc_score(self.nodes[key])
+            if key in small_fragments:
+                continue
+            if min_score is not None and self.nodes[key].score < min_score:
+                continue
+            keys.append(key)
+        def sortkey(key):
+            return self.nodes[key].score
+        if top_n is not None:
+            # a heap of top_n keys, equivalent to (but cheaper than) sorting all keys and taking the first top_n
+            return heapq.nlargest(top_n, keys, key=sortkey)
+        keys.sort(key=sortkey, reverse=True)
+        return keys
 
-    def calc_score(self, node):
-        if node.score != None:
-            return
-        else:
-            node.score = -1 # Indicating the score is "waiting" for a result
-            for idx, pkey in enumerate(node.parents):
-                if self.nodes[pkey].score is None:      # No calculation is requested for parents with score -1,
-                    self.calc_score(self.nodes[pkey])   # to avoid closed loops ....
-                newscore = self.nodes[pkey].score * float(node.parents[pkey].probability)
-                if node.score < newscore:   # This implies that parents with a newscore of -1 are ignored,
-                    node.score = newscore   # to avoid closed loops ...
-                    uniqueIdent = ""
-                    if node.uniqueIdent > 0:
-                        uniqueIdent = "_" + str(node.uniqueIdent)
-                    # if the current node has multiple parents, concatenate their paths with &&&
-                    if idx>0: node.pathway += "&&&"
-                    node.pathway = self.nodes[pkey].pathway + str(node.parents[pkey].rulename).strip() + uniqueIdent + ";"
+    def iter_metabolites(self, filter_small_fragments=True, min_score=None, top_n=None, parent_column='parent'):
+        """
+        Generate metabolites in order of decreasing probability score
+
+        :param filter_small_fragments:
+            Boolean to activate filtering all metabolites with less then 15% of original atoms (of the parent)
+        :param min_score:
+            Only generate metabolites with a score of at least min_score
+        :param top_n:
+            Integer, only generate the top_n metabolites with the highest scores
+        :param parent_column:
+            String containing the name for the column with the parent molecule
+        :return:
+            A generator of dictionaries for each metabolite, containing the SyGMa_metabolite (an RDKit Molecule),
+            SyGMa_pathway and SyGMa_score
+        """
+        parentmol = self.nodes[self.parentkey].mol
+        for key in self._output_keys(filter_small_fragments, min_score, top_n):
+            node = self.nodes[key]
+            yield {parent_column: parentmol,
+                   "SyGMa_pathway": "parent;" if key == self.parentkey else node.pathway,
+                   "SyGMa_metabolite": node.mol,
+                   "SyGMa_score": node.score}
 
     def to_list(self, filter_small_fragments = True, parent_column = 'parent'):
         """
@@ -123,24 +755,7 @@ class Tree(object):
             A list of dictionaries for each metabolites, containing the SyGMa_metabolite (an RDKit Molecule),
             SyGMa_pathway and SyGMa_score, sorted by decreasing probability.
         """
-        def sortkey(rowdict):
-            return rowdict['SyGMa_score']
-        output_list = []
-        smallFragmentChildren = []
-        n_parent_atoms = self.nodes[self.parentkey].mol.GetNumAtoms()
-        for key in self.nodes:
-            if key in smallFragmentChildren: continue
-            if filter_small_fragments and float(self.nodes[key].n_original_atoms) <= 0.15 * n_parent_atoms:
-                # put keys of children of the small fragments on a blacklist
-                smallFragmentChildren = self.nodes[key].children
-                continue
-            pathway = "parent;" if key == self.parentkey else self.nodes[key].pathway
-            output_list.append({parent_column: self.nodes[self.parentkey].mol,
-                         "SyGMa_pathway": pathway,
-                         "SyGMa_metabolite": self.nodes[key].mol,
-                         "SyGMa_score": self.nodes[key].score})
-        output_list.sort(key=sortkey, reverse=True)
-        return output_list
+        return list(self.iter_metabolites(filter_small_fragments=filter_small_fragments, parent_column=parent_column))
 
     def to_smiles(self, filter_small_fragments = True):
         """
@@ -152,13 +767,30 @@ class Tree(object):
             A list of metabolites as list ``[[SyGMa_metabolite as smiles, SyGMa_score]]``
             sorted by decreasing probability score.
         """
-        output_list = self.to_list(filter_small_fragments=filter_small_fragments)
-        smiles_list = []
-        for entry in output_list:
-            smiles_list.append([Chem.MolToSmiles(entry['SyGMa_metabolite']),entry['SyGMa_score']])
-        return smiles_list
+        return [[Chem.MolToSmiles(entry['SyGMa_metabolite']), entry['SyGMa_score']]
+                for entry in self.iter_metabolites(filter_small_fragments=filter_small_fragments)]
+
+    def write_smiles(self, file=sys.stdout, filter_small_fragments=True, min_score=None, top_n=None, properties=None):
+        """
+        Write metabolites as lines with the smiles and the SyGMa score, sorted by decreasing probability score
+
+        :param file:
+            The file to write to
+        :param filter_small_fragments:
+            Boolean to activate filtering all metabolites with less then 15% of original atoms (of the parent)
+        :param min_score:
+            Only write metabolites with a score of at least min_score
+        :param top_n:
+            Integer, only write the top_n metabolites with the highest scores
+        :param properties:
+            Dictionary with additional properties whose values are added to each line, e.g. an identifier of the parent
+        """
+        suffix = "".join(" " + str(value) for value in (properties or {}).values())
+        for entry in self.iter_metabolites(filter_small_fragments=filter_small_fragments, min_score=min_score,
+                                           top_n=top_n):
+            file.write(Chem.MolToSmiles(entry['SyGMa_metabolite']) + " " + str(entry['SyGMa_score']) + suffix + "\n")
 
-    def write_sdf(self, file=sys.stdout, filter_small_fragments = True):
+    def write_sdf(self, file=sys.stdout, filter_small_fragments = True, properties=None, min_score=None, top_n=None):
         """
         Generate an SDFile with metabolites including the SyGMa_pathway and the SyGMa score as properties
 
@@ -166,11 +798,86 @@ class Tree(object):
             The SDF file to write to
         :param filter_small_fragments:
             Boolean to activate filtering all metabolites with less then 15% of original atoms (of the parent)
+        :param properties:
+            Dictionary with additional properties to add to each metabolite, e.g. an identifier of the parent
+        :param min_score:
+            Only write metabolites with a score of at least min_score
+        :param top_n:
+            Integer, only write the top_n metabolites with the highest scores
         """
-        output_list = self.to_list(filter_small_fragments=filter_small_fragments)
         sdf = Chem.SDWriter(file)
-        for entry in output_list:
-            mol = entry['SyGMa_metabolite']
-            mol.SetProp("Pathway", entry['SyGMa_pathway'][:-1])
-            mol.SetProp("Score", str(entry['SyGMa_score']))
+        for key in self._output_keys(filter_small_fragments, min_score, top_n):
+            node = self.nodes[key]
+            self._gen_coords(node)  # coordinates are only generated for the metabolites that are written
+            mol = Chem.Mol(node.mol)  # a copy, to leave the molecules in the tree unchanged
+            if self.identity != "inchikey" and key != self.parentkey:
+                # InChIKeys are only computed for the metabolites that are written
+                mol.SetProp("_Name", mol_to_ikey(mol))
+            mol.SetProp("Pathway", "parent" if key == self.parentkey else node.pathway[:-1])
+            mol.SetProp("Score", str(node.score))
+            for name, value in (properties or {}).items():
+                mol.SetProp(name, str(value))
             sdf.write(mol)
+        sdf.flush()
+
+    def write_tree(self, file):
+        """
+        Write the tree as JSON lines to a file object, to be read back with :func:`read_tree`: a header with
+        the identity strategy, metadata, rules and the nodes metabolized with each set of rules, followed by
+        a line for each node (see :meth:`sygma.TreeNode.to_dict`).
+        As the expanded nodes are kept, metabolize_all_nodes continues a read tree where it stopped.
+        """
+        header = {'format': 'sygma-tree', 'version': TREE_FORMAT_VERSION,
+                  'parentkey': getattr(self, 'parentkey', None), 'identity': self.identity,
+                  'metadata': self.metadata, 'truncated': self.truncated, 'n_keys': len(self.keys),
+                  'rules': [{'rulename': rule.rulename, 'probability': rule.probability, 'smarts': rule.smarts,
+                             'max_products': rule.max_products, 'names': rule.names} for rule in self.rules],
+                  'expanded': dict((key, sorted(ikeys)) for key, ikeys in self.expanded.items()),
+                  'ruleset_rules': dict((key, sorted(rkeys, key=str)) for key, rkeys in self.ruleset_rules.items())}
+        file.write(json.dumps(header) + "\n")
+        # in the order of self.nodes, which is the order in which they are metabolized
+        for node in self.nodes.values():
+            file.write(json.dumps(node.to_dict()) + "\n")
+
+
+def read_tree(file, rules=None, memo=None, profile=False):
+    """
+    Read a tree written by :meth:`Tree.write_tree`
+
+    :param file:
+        A file object
+    :param rules:
+        List of rules, e.g. read by :func:`sygma.read_reaction_rules`, that are used for the rules of the tree
+        with the same name, probability and smarts. The other rules are compiled from their smarts.
+    :param memo, profile:
+        See :class:`Tree`
+    :return:
+        A Tree, which can be metabolized further
+    """
+    from sygma.scenario import Rule
+    header = json.loads(file.readline())
+    if header.get('format') != 'sygma-tree' or header.get('version') != TREE_FORMAT_VERSION:
+        raise ValueError('Not a SyGMa tree of format version {}'.format(TREE_FORMAT_VERSION))
+    tree = Tree(identity=header['identity'], memo=memo, profile=profile)
+    tree.parentkey = header['parentkey']
+    tree.metadata = header['metadata']
+    tree.truncated = header['truncated']
+    known = dict(((rule.rulename, rule.probability, rule.smarts), rule) for rule in rules or [])
+    for data in header['rules']:
+        rule = known.get((data['rulename'], data['probability'], data['smarts']))
+        if rule is None:
+            rule = Rule(data['rulename'], data['probability'], data['smarts'], max_products=data['max_products'],
+                        names=data.get('names'))
+        # the parents of the nodes refer to the rules by their position in the header
+        tree._rule_indices.setdefault((rule.rulename, rule.probability, rule.smarts), len(tree.rules))
+        tree.rules.append(rule)
+    tree.expanded = dict((key, set(ikeys)) for key, ikeys in header['expanded'].items())
+    tree.ruleset_rules = dict((key, set(tuple(rkey) for rkey in rkeys))
+                              for key, rkeys in header.get('ruleset_rules', {}).items())
+    tree.keys = [None] * header['n_keys']
+    for line in file:
+        if line.strip():
+            node = TreeNode.from_dict(json.loads(line))
+            tree.nodes[node.ikey] = node
+            tree.keys[node.index] = node.ikey
+    return tree
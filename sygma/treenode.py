@@ -1,68 +1,196 @@
 from rdkit import Geometry
 from rdkit import Chem
-from rdkit.Chem import AllChem, rdMolTransforms
+import base64
+from rdkit.Chem import AllChem, rdMolHash, rdMolTransforms
 
 
-class TreeNode:
+# Boolean atom property marking the atoms that originate from the parent molecule
+ORIGINAL = "_sygma_original"
+
+# Integer atom property of the fragments of TreeNode.reactants with the index of the atom in TreeNode.mol
+ATOM_INDEX = "_sygma_index"
+
+
+def mol_to_ikey(mol):
+    """
+    Return the key identifying a metabolite: the first 14 characters of its InChIKey,
+    or its isomeric smiles if no InChI can be generated
+    """
+    try:
+        return AllChem.InchiToInchiKey(AllChem.MolToInchi(mol))[:14]
+    except Exception as e:
+        return Chem.MolToSmiles(mol, 1)
+
+
+def mol_to_smiles_key(mol):
+    """Return the canonical isomeric smiles of a metabolite as its key"""
+    return Chem.MolToSmiles(mol, 1)
+
+
+def mol_to_molhash_key(mol):
+    """Return the RDKit tautomer insensitive MolHash of a metabolite as its key"""
+    return rdMolHash.MolHash(mol, rdMolHash.HashFunction.HetAtomTautomer)
+
+
+# Strategies to compute the key on which metabolites are deduplicated in a Tree
+identity_keys = {
+    "inchikey": mol_to_ikey,
+    "smiles": mol_to_smiles_key,
+    "molhash": mol_to_molhash_key,
+}
+
+
+def implicit_hydrogens(mol):
+    """
+    Make the hydrogens of uncharged atoms implicit where the default valence gives the same hydrogen count,
+    as parsing the smiles of mol would. Reactions set explicit hydrogen counts on the atoms in their products,
+    which would otherwise be kept when a later reaction changes the bonds of such an atom.
+    """
+    for atom in mol.GetAtoms():
+        if atom.GetNoImplicit() and atom.GetFormalCharge() == 0 and atom.GetNumRadicalElectrons() == 0:
+            n_hydrogens = atom.GetTotalNumHs()
+            explicit = atom.GetNumExplicitHs()
+            atom.SetNoImplicit(False)
+            atom.SetNumExplicitHs(0)
+            atom.UpdatePropertyCache(strict=False)
+            if atom.GetTotalNumHs() != n_hydrogens:
+                atom.SetNoImplicit(True)
+                atom.SetNumExplicitHs(explicit)
+                atom.UpdatePropertyCache(strict=False)
+
+
+# Pickle options of the RDKit binaries in which the molecules of nodes are stored
+PICKLE_PROPS = Chem.PropertyPickleOptions.MolProps | Chem.PropertyPickleOptions.AtomProps | \
+    Chem.PropertyPickleOptions.PrivateProps
+
+
+class TreeNode(object):
     """
     Class containing a node of the SyGMa tree
 
     :key mol:
-        RDKit Molecule
+        RDKit Molecule, stored as an RDKit binary and decoded on each access
+    :key reactants:
+        Tuple with the fragments of mol, built when the node is metabolized
+    :key index:
+        Integer identifying the node in its tree, see Tree.keys
     :key parents:
-        Dictonary {inchikey_of_parent: rulename_transforming_parent_to_self}
+        Dictonary {index_of_parent: index_of_rule_transforming_parent_to_self}, see Tree.rules
     :key children:
-        List of inchikeys of the child nodes
+        Set of indices of the child nodes
     :key score:
         Value between 0 and 1
     :key pathway:
         String describing the pathway from parent to self
     :key n_original_atoms:
-        Integer, number of atoms originating from parent or None if not yet determined
+        Integer, number of atoms originating from parent, i.e. with the ORIGINAL atom property.
+        If no atom of mol has this property, mol is the parent and all its atoms are original.
+    :key ikey:
+        String identifying the metabolite, computed from mol with the identity strategy if not given
     """
+    __slots__ = ('_mol', '_reactants', 'index', 'parents', 'children', 'ikey', 'score', 'pathway', 'uniqueIdent',
+                 'n_original_atoms')
 
-    def __init__(self, mol, parent="", rule=None, score=None, pathway="", uniqueIdent=""):
+    def __init__(self, mol, parent=None, rule=None, score=None, pathway="", uniqueIdent="", ikey=None,
+                 identity="inchikey", index=0):
+        if not any(atom.HasProp(ORIGINAL) for atom in mol.GetAtoms()):
+            for atom in mol.GetAtoms():
+                atom.SetBoolProp(ORIGINAL, True)
         self.mol = mol
-        self.reactants = [Chem.MolFromSmiles(part) for part in Chem.MolToSmiles(mol).split('.')]
+        self._reactants = None
+        self.index = index
         self.parents = {parent: rule}
-        self.children = []
-        try:
-            self.ikey = AllChem.InchiToInchiKey(AllChem.MolToInchi(mol))[:14]
-        except Exception as e:
-            self.ikey = Chem.MolToSmiles(mol, 1)
-            # print("some error in treenode_init_")
-        # self.ikey = AllChem.InchiToInchiKey(AllChem.MolToInchi(mol))[:14]
+        self.children = set()
+        self.ikey = ikey if ikey is not None else identity_keys[identity](mol)
         self.score = score
         self.pathway = pathway
         self.uniqueIdent = uniqueIdent
-        self.n_original_atoms = None
+        self.n_original_atoms = sum(1 for atom in mol.GetAtoms() if atom.GetBoolProp(ORIGINAL))
+
+    @property
+    def mol(self):
+        return Chem.Mol(self._mol)
+
+    @mol.setter
+    def mol(self, mol):
+        self._mol = mol.ToBinary(PICKLE_PROPS)
+
+    @property
+    def reactants(self):
+        """
+        Fragments of mol, keeping the ORIGINAL atom property and with the index of each atom in mol as
+        the ATOM_INDEX atom property, built on first access and kept until released with `del node.reactants`
+        """
+        if self._reactants is None:
+            mol = self.mol
+            fragment_ids = []
+            atom_indices = []
+            fragments = Chem.GetMolFrags(mol, asMols=True, frags=fragment_ids, fragsMolAtomMapping=atom_indices)
+            for fragment, indices in zip(fragments, atom_indices):
+                for atom, idx in zip(fragment.GetAtoms(), indices):
+                    atom.SetIntProp(ATOM_INDEX, idx)
+            if len(fragments) > 1:
+                # order the fragments as in the canonical smiles, the order in which rules combine them
+                Chem.MolToSmiles(mol)
+                first = {}
+                for idx in mol.GetPropsAsDict(True, True)['_smilesAtomOutputOrder']:
+                    first.setdefault(fragment_ids[idx], len(first))
+                fragments = [fragments[frag] for frag in sorted(first, key=first.get)]
+            for fragment in fragments:
+                implicit_hydrogens(fragment)
+            self._reactants = fragments
+        return self._reactants
+
+    @reactants.deleter
+    def reactants(self):
+        self._reactants = None
+
+    def to_dict(self):
+        """Return the node as a dictionary of JSON serializable values, with mol as a base64 encoded RDKit binary"""
+        return {'index': self.index, 'ikey': self.ikey, 'mol': base64.b64encode(self._mol).decode('ascii'),
+                'parents': [[pidx, ridx] for pidx, ridx in self.parents.items()], 'children': sorted(self.children),
+                'score': self.score, 'pathway': self.pathway, 'uniqueIdent': self.uniqueIdent,
+                'n_original_atoms': self.n_original_atoms}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Return the node of a dictionary made by to_dict"""
+        node = cls.__new__(cls)
+        node._mol = base64.b64decode(data['mol'])
+        node._reactants = None
+        node.index = data['index']
+        node.parents = dict((pidx, ridx) for pidx, ridx in data['parents'])
+        node.children = set(data['children'])
+        node.ikey = data['ikey']
+        node.score = data['score']
+        node.pathway = data['pathway']
+        node.uniqueIdent = data['uniqueIdent']
+        node.n_original_atoms = data['n_original_atoms']
+        return node
 
     def gen_coords(self):
         """
         Calculate 2D positions for atoms in self.mol without coordinates
         """
-        # print(Chem.MolToSmiles(self.mol))
-        # if self.mol.GetNumConformers() == 0:
-        #     Chem.AddHs(self.mol)
-        #     AllChem.EmbedMolecule(self.mol)
-        #     Chem.RemoveHs(self.mol)
+        mol = self.mol
+        # print(Chem.MolToSmiles(mol))
+        # if mol.GetNumConformers() == 0:
+        #     Chem.AddHs(mol)
+        #     AllChem.EmbedMolecule(mol)
+        #     Chem.RemoveHs(mol)
         try:
-            conf = self.mol.GetConformer(0)		
+            conf = mol.GetConformer(0)		
             coord_dict = {}
             # Put known coordinates in coordDict
-            for i in range(self.mol.GetNumAtoms()):
+            for i in range(mol.GetNumAtoms()):
                 pos = conf.GetAtomPosition(i)
                 if pos.x != 0.0 or pos.y != 0.0:
                     coord_dict[i] = Geometry.Point2D(pos.x, pos.y)
-            # Currently the presence of coordinates is used to determine n_original_atoms
-            # This requires SyGMa to always work with structures with atomic coordinates
-            # TODO: Derive n_original_atoms independent from the calculation of coordinates
-            self.n_original_atoms = len(coord_dict)
-            if self.n_original_atoms > 1:
+            if len(coord_dict) > 1:
                 # calculate average length of all bonds with coordinates
                 total = 0.0
                 n = 0
-                for bond in self.mol.GetBonds():
+                for bond in mol.GetBonds():
                     b = bond.GetBeginAtomIdx()
                     e = bond.GetEndAtomIdx()
                     if b in coord_dict and e in coord_dict:
@@ -70,10 +198,10 @@ class TreeNode:
                         total += rdMolTransforms.GetBondLength(conf, b, e)
                 av = total / n
                 # compute coordinates for new atoms, keeping known coordinates
-                AllChem.Compute2DCoords(self.mol, coordMap=coord_dict, bondLength=av)
+                AllChem.Compute2DCoords(mol, coordMap=coord_dict, bondLength=av)
             else:
-                AllChem.Compute2DCoords(self.mol)
+                AllChem.Compute2DCoords(mol)
 
         except (ValueError, ZeroDivisionError):
-            AllChem.Compute2DCoords(self.mol)
-            self.n_original_atoms = self.mol.GetNumAtoms()
\ No newline at end of file
+            AllChem.Compute2DCoords(mol)
+        self.mol = mol